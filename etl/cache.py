@@ -0,0 +1,228 @@
+"""
+Local cache of downloaded resources.
+
+Imports, dry runs and import reports fetch the same data files and
+models over and over. The cache keeps a copy of each HTTP resource,
+keyed by URL, together with its ETag and Last-Modified headers. The
+next time the URL is opened, the request is made conditional on them,
+and if the server answers 304 Not Modified, the copy is read instead.
+
+Copies are stored under the SHA1 digest of their content, so that a
+file published under several URLs is stored once. The total size of
+the copies is bounded; when it is exceeded, the resources used least
+recently are dropped.
+
+A resource is only stored once it has been read to the end, so reading
+the first lines of a file does not leave a partial copy behind.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib2
+from threading import RLock
+
+from openspending.etl.download import HeadRequest
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(sys.prefix, 'var', 'cache', 'openspendingetld')
+
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+
+class DownloadCache(object):
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE,
+                 opener=None):
+        self.directory = directory or DEFAULT_DIR
+        self.max_size = max_size
+        # Function opening URLs which have no copy yet.
+        self.opener = opener
+        self.lock = RLock()
+
+        objects = os.path.join(self.directory, 'objects')
+        if not os.path.isdir(objects):
+            os.makedirs(objects)
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                  check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS resource ("
+                        "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                        "digest TEXT, size INTEGER, used REAL)")
+        self.db.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def lookup(self, url):
+        """ Return ``(etag, last_modified, digest)`` of the cached copy
+        of ``url``, or None. """
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, digest "
+                                  "FROM resource WHERE url = ?",
+                                  (url,)).fetchone()
+        if row is None or not os.path.exists(self.object_path(row[2])):
+            return None
+        return row
+
+    def open(self, url):
+        """ Open ``url`` for reading, from the cache if the copy there
+        is still current. """
+        entry = self.lookup(url)
+        if entry is None:
+            fp = self._download(url)
+        else:
+            # If the resource has changed, the response is read into the
+            # new copy rather than requested again.
+            fp = self._revalidate(url, entry)
+            if fp is None:
+                log.info("Reading %s from the download cache", url)
+                self.touch(url)
+                return open(self.object_path(entry[2]), 'rb')
+
+        headers = fp.info()
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        if not etag and not last_modified:
+            # There would be no way of telling whether a copy is
+            # current.
+            return fp
+        return CachingReader(fp, self, url, etag, last_modified)
+
+    def current_copy(self, url):
+        """ Return the path of the cached copy of ``url`` if it is still
+        current, else None. Unlike ``open``, this does not download the
+        resource if it has changed. """
+        entry = self.lookup(url)
+        if entry is None:
+            return None
+        fp = self._revalidate(url, entry, HeadRequest)
+        if fp is not None:
+            fp.close()
+            return None
+        self.touch(url)
+        return self.object_path(entry[2])
+
+    def _download(self, url):
+        if self.opener is not None:
+            return self.opener(url)
+        return urllib2.urlopen(urllib2.Request(url))
+
+    def _revalidate(self, url, entry, request_class=urllib2.Request):
+        """ Make a conditional request for ``url``, returning None if
+        the cached copy is current, else the response. """
+        etag, last_modified, digest = entry
+        request = request_class(url)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+        try:
+            return urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+    def touch(self, url):
+        with self.lock:
+            self.db.execute("UPDATE resource SET used = ? WHERE url = ?",
+                            (time.time(), url))
+            self.db.commit()
+
+    def store(self, url, etag, last_modified, path, digest, size):
+        """ Add the file at ``path``, which is left in place, as the
+        copy of ``url``. """
+        with self.lock:
+            target = self.object_path(digest)
+            if not os.path.exists(target):
+                os.link(path, target)
+            self.db.execute("INSERT OR REPLACE INTO resource VALUES "
+                            "(?, ?, ?, ?, ?, ?)",
+                            (url, etag, last_modified, digest, size,
+                             time.time()))
+            self.db.commit()
+            self.evict()
+
+    def evict(self):
+        """ Drop the least recently used copies until the cache fits
+        into ``max_size``. """
+        with self.lock:
+            rows = self.db.execute("SELECT url, digest, size FROM resource "
+                                   "ORDER BY used").fetchall()
+            sizes = dict((digest, size) for url, digest, size in rows)
+            total = sum(sizes.values())
+            users = {}
+            for url, digest, size in rows:
+                users[digest] = users.get(digest, 0) + 1
+
+            for url, digest, size in rows:
+                if total <= self.max_size:
+                    break
+                self.db.execute("DELETE FROM resource WHERE url = ?", (url,))
+                users[digest] -= 1
+                if not users[digest]:
+                    total -= size
+                    path = self.object_path(digest)
+                    if os.path.exists(path):
+                        os.remove(path)
+                log.info("Dropped %s from the download cache", url)
+            self.db.commit()
+
+
+class CachingReader(object):
+    """ File-like object reading a HTTP response, which writes the data
+    read to a temporary file and adds it to the cache at the end. """
+
+    def __init__(self, fp, cache, url, etag, last_modified):
+        self.fp = fp
+        self.cache = cache
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.temp = tempfile.NamedTemporaryFile(dir=cache.directory,
+                                                prefix='download-')
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def info(self):
+        return self.fp.info()
+
+    def geturl(self):
+        return self.fp.geturl()
+
+    def read(self, size=-1):
+        data = self.fp.read(size) if size >= 0 else self.fp.read()
+        if self.temp is None:
+            return data
+        if data:
+            self.temp.write(data)
+            self.hash.update(data)
+            self.size += len(data)
+        if not data and size != 0 or size < 0:
+            self._finish()
+        return data
+
+    def _finish(self):
+        temp, self.temp = self.temp, None
+        try:
+            length = self.fp.info().get('content-length')
+            if length is not None and int(length) != self.size:
+                log.warn("Download of %s ended after %d of %s bytes, not "
+                         "caching it", self.url, self.size, length)
+                return
+            temp.flush()
+            self.cache.store(self.url, self.etag, self.last_modified,
+                             temp.name, self.hash.hexdigest(), self.size)
+        finally:
+            temp.close()
+
+    def close(self):
+        self.fp.close()
+        if self.temp is not None:
+            self.temp.close()
+            self.temp = None
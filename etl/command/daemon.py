@@ -41,6 +41,9 @@ from paste.deploy import appconfig
 from openspending.etl import tasks
 from openspending.etl.ui.config.environment import load_environment
 
+# Id of the job running in this process, set by run_job.
+_current_job_id = None
+
 class TaskNotFoundError(Exception):
     pass
 
@@ -61,6 +64,32 @@ def pidfile_path(job_id):
     """Return path to pid file for job <job_id>"""
     return os.path.join(sys.prefix, 'var', 'run', 'openspendingetld_%s.pid' % job_id)
 
+def checkpoint_path(job_id):
+    """Return path to import checkpoint file for job <job_id>"""
+    return os.path.join(sys.prefix, 'var', 'run', 'openspendingetld_%s.checkpoint' % job_id)
+
+def errors_path(job_id):
+    """Return path to import error file for job <job_id>"""
+    return os.path.join(sys.prefix, 'var', 'log', 'openspendingetld_%s.errors' % job_id)
+
+def current_checkpoint_path():
+    """\
+    Return path to the checkpoint file of the job running in this process,
+    or None when not running as a job.
+    """
+    if _current_job_id is None:
+        return None
+    return checkpoint_path(_current_job_id)
+
+def current_errors_path():
+    """\
+    Return path to the error file of the job running in this process,
+    or None when not running as a job.
+    """
+    if _current_job_id is None:
+        return None
+    return errors_path(_current_job_id)
+
 def job_running(job_id):
     """\
     Return True if job <job_id> is considered to be running by presence of pid
@@ -89,6 +118,19 @@ def job_log(job_id):
     with open(logfile_path(job_id)) as f:
         return f.read()
 
+def job_errors(job_id):
+    """\
+    Return an ErrorSummary of the import errors of job <job_id>, or None
+    if it has not written any. This reads the summary the import saves
+    with its error file, rather than the errors themselves.
+    """
+    from openspending.etl.importer.errors import ErrorSummary, summary_path
+
+    path = summary_path(errors_path(job_id))
+    if not os.path.exists(path):
+        return None
+    return ErrorSummary.load(path)
+
 def main():
     args = sys.argv[1:]
 
@@ -100,6 +142,8 @@ def main():
     run_job(*args)
 
 def run_job(job_id, configfile, task, *args):
+    global _current_job_id
+
     configfile_path = os.path.abspath(configfile)
 
     _create_directories()
@@ -146,6 +190,7 @@ def run_job(job_id, configfile, task, *args):
             raise TaskNotFoundError("No task called '%s' exists in openspending.etl.tasks!" % task)
 
         # Run task, passing leftover arguments
+        _current_job_id = job_id
         t(*args)
 
 def _load_environment(configfile_path):
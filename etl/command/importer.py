@@ -3,12 +3,11 @@ from __future__ import print_function
 import argparse
 import logging
 import sys
-import urllib2
 
 from openspending.etl.importer import ckan
 from openspending.lib import json
 
-from openspending.etl import util
+from openspending.etl import download, util
 from openspending.etl.importer import CSVImporter, CKANImporter, ImporterError
 
 log = logging.getLogger(__name__)
@@ -30,14 +29,92 @@ import_parser.add_argument('--max-lines', action="store", dest='max_lines',
                            type=int, default=None, metavar='N',
                            help="Number of lines to import.")
 
+import_parser.add_argument('--batch-size', action="store", dest='batch_size',
+                           type=int, default=None, metavar='N',
+                           help="Number of entries to load per database transaction.")
+
+import_parser.add_argument('--workers', action="store", dest='workers',
+                           type=int, default=None, metavar='N',
+                           help="Number of processes to convert data in.")
+
+import_parser.add_argument('--pipeline', action="store_true", dest='pipeline',
+                           default=False,
+                           help="Read and write data in background threads.")
+
+import_parser.add_argument('--checkpoint', action="store", dest='checkpoint',
+                           default=None, metavar='FILE',
+                           help="Periodically save import progress to FILE.")
+
+import_parser.add_argument('--resume', action="store_true", dest='resume',
+                           default=False,
+                           help="Resume the import from the --checkpoint file.")
+
+import_parser.add_argument('--tuple-rows', action="store_true", dest='tuple_rows',
+                           default=False,
+                           help="Read CSV rows as lists of cells rather than dicts (faster for wide files).")
+
+import_parser.add_argument('--columnar', action="store_true", dest='columnar',
+                           default=False,
+                           help="Convert blocks of lines column by column (uses NumPy if installed).")
+
+import_parser.add_argument('--dimension-keys', action="store_true",
+                           dest='dimension_keys', default=False,
+                           help="Load each dimension member once and reuse its keys for all entries.")
+
+import_parser.add_argument('--max-line-length', action="store",
+                           dest='max_line_length', type=int,
+                           default=util.MAX_LINE_LENGTH, metavar='BYTES',
+                           help="Longest line of source data to read (default %(default)s bytes).")
+
+import_parser.add_argument('--skip-long-lines', action="store_true",
+                           dest='skip_long_lines', default=False,
+                           help="Skip lines longer than --max-line-length rather than aborting the import.")
+
+import_parser.add_argument('--incremental', action="store_true",
+                           dest='incremental', default=False,
+                           help="Only load entries which are new or have changed since the last import.")
+
+import_parser.add_argument('--error-file', action="store", dest='error_file',
+                           default=None, metavar='FILE',
+                           help="Append all import errors to FILE, one JSON record per line.")
+
+import_parser.add_argument('--no-cache', action="store_false",
+                           dest='download_cache', default=True,
+                           help="Download resources again even if a cached copy is current.")
+
+import_parser.add_argument('--cache-dir', action="store", dest='cache_dir',
+                           default=None, metavar='DIR',
+                           help="Directory of the download cache.")
+
+import_parser.add_argument('--connections', action="store",
+                           dest='connections', type=int, default=download.CONNECTIONS,
+                           metavar='N',
+                           help="Download large resources over N connections at once, if the server allows it.")
+
 import_parser.add_argument('--raise-on-error', action="store_true",
                            dest='raise_errors', default=False,
                            help='Get full traceback on first error.')
 
+def _configure_downloads(args):
+    util.enable_ranged_download(args.connections)
+    if args.download_cache:
+        util.enable_download_cache(args.cache_dir)
+
+def _check_resume(args):
+    if args.resume and not args.checkpoint:
+        print("You must specify a checkpoint file (--checkpoint) to resume from!",
+              file=sys.stderr)
+        return False
+    return True
+
 def csvimport(csv_data_url, args):
+    if not _check_resume(args):
+        return 1
+
+    _configure_downloads(args)
 
     def json_of_url(url):
-        return json.load(urllib2.urlopen(url))
+        return json.load(util.open_url(url))
 
     if args.model:
         model = json_of_url(args.model)
@@ -53,6 +130,10 @@ def csvimport(csv_data_url, args):
     return 0
 
 def ckanimport(package_name, args):
+    if not _check_resume(args):
+        return 1
+
+    _configure_downloads(args)
     package = ckan.Package(package_name)
 
     if not args.use_ckan_tags:
@@ -74,6 +155,8 @@ def ckanimport(package_name, args):
     return 0
 
 def importreport():
+    util.enable_download_cache()
+
     print("-- Finding OpenSpending packages on CKAN...", file=sys.stderr)
 
     packages = [ p for p in ckan.openspending_packages() ]
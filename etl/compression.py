@@ -0,0 +1,249 @@
+"""
+Streaming decompression of source data.
+
+Data files are often published compressed. Rather than having them
+decompressed to disk first, the stream of blocks read from a URL is
+decompressed as it is read. gzip, bzip2 and zip archives holding a
+single file are supported; the format is recognised by the magic bytes
+at the start of the data.
+"""
+
+import bz2
+import logging
+import struct
+import zlib
+from itertools import chain
+
+log = logging.getLogger(__name__)
+
+# Largest block of decompressed data returned at once, so that a small
+# block of highly compressed data does not expand to megabytes.
+BLOCK_SIZE = 64 * 1024
+
+# Formats implied by Content-Type and Content-Encoding headers, which
+# are only checked against the magic bytes.
+_CONTENT_TYPES = {
+    'application/gzip': 'gzip',
+    'application/x-gzip': 'gzip',
+    'application/x-bzip2': 'bz2',
+    'application/zip': 'zip',
+    'application/x-zip-compressed': 'zip',
+}
+_CONTENT_ENCODINGS = {
+    'gzip': 'gzip',
+    'x-gzip': 'gzip',
+}
+
+_ZIP_SIGNATURE = 'PK\x03\x04'
+_ZIP_DESCRIPTOR_SIGNATURE = 'PK\x07\x08'
+_ZIP_HEADER = struct.Struct('<4s5H3I2H')
+_ZIP_ENCRYPTED = 0x1
+_ZIP_DESCRIPTOR = 0x8
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+
+
+class CompressedDataError(ValueError):
+    """ Compressed source data is corrupt or in an unsupported form. """
+
+
+def detect_compression(head, headers=None):
+    """\
+    Return the compression format (``'gzip'``, ``'bz2'`` or ``'zip'``)
+    of data starting with ``head``, or None for uncompressed data.
+
+    ``headers`` are the HTTP headers the data was served with, if any.
+    Servers do get them wrong, so they are only compared with the magic
+    bytes, which decide.
+    """
+    compression = None
+    if head.startswith('\x1f\x8b'):
+        compression = 'gzip'
+    elif head.startswith('BZh') and head[3:4].isdigit() \
+            and head[4:10] in ('1AY&SY', '\x17rE8P\x90'):
+        compression = 'bz2'
+    elif head.startswith(_ZIP_SIGNATURE):
+        compression = 'zip'
+
+    if headers is not None:
+        content_type = headers.get('content-type', '').split(';')[0]
+        encoding = headers.get('content-encoding', '')
+        claimed = _CONTENT_TYPES.get(content_type.strip().lower()) \
+            or _CONTENT_ENCODINGS.get(encoding.strip().lower())
+        if claimed and claimed != compression:
+            log.warn("Data served as %s does not look like it, reading "
+                     "it as %s", claimed, compression or "uncompressed data")
+    return compression
+
+def decompress_blocks(blocks, compression):
+    """ Yield the decompressed data of a stream of blocks of data
+    compressed with ``compression``, see ``detect_compression``. """
+    return _DECOMPRESSORS[compression](iter(blocks))
+
+def _inflate(decompressor, block, name):
+    """ Yield the data decompressed from ``block``, in pieces of at
+    most BLOCK_SIZE bytes. """
+    while block:
+        try:
+            data = decompressor.decompress(block, BLOCK_SIZE)
+        except zlib.error as e:
+            raise CompressedDataError("Invalid %s data: %s" % (name, e))
+        if data:
+            yield data
+        if decompressor.unused_data:
+            # The end of the stream; the rest of the input is left in
+            # both unused_data and unconsumed_tail.
+            break
+        block = decompressor.unconsumed_tail
+
+def _finish(decompressor, name):
+    """ Return the rest of the data of a zlib stream at the end of the
+    input, raising a CompressedDataError if the stream was cut short.
+    Python 2 decompressors don't tell whether they have seen the end of
+    the stream, unless given more input: it then ends up in unused_data
+    rather than being decompressed. """
+    if decompressor.unused_data:
+        return ''
+    try:
+        data = decompressor.decompress('\0')
+    except zlib.error as e:
+        raise CompressedDataError("Truncated %s data: %s" % (name, e))
+    if not decompressor.unused_data:
+        raise CompressedDataError("Truncated %s data" % name)
+    return data
+
+def _split(data):
+    """ Yield ``data`` in pieces of at most BLOCK_SIZE bytes. """
+    for start in xrange(0, len(data), BLOCK_SIZE):
+        yield data[start:start + BLOCK_SIZE]
+
+def _gunzip(blocks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in blocks:
+        while block:
+            for data in _inflate(decompressor, block, 'gzip'):
+                yield data
+            # Data following the end of the stream is the next member
+            # of a multi-member file, or padding.
+            block = decompressor.unused_data
+            if block.strip('\0'):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                block = ''
+    data = _finish(decompressor, 'gzip')
+    if data:
+        yield data
+
+def _bunzip2(blocks):
+    decompressor = bz2.BZ2Decompressor()
+    for block in blocks:
+        while block:
+            try:
+                data = decompressor.decompress(block)
+            except EOFError:
+                # The end of a stream; parallel bzip2 tools write
+                # several.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            except IOError as e:
+                raise CompressedDataError("Invalid bz2 data: %s" % e)
+            # Unlike zlib, bz2 can't limit the size of its output.
+            for piece in _split(data):
+                yield piece
+            block = decompressor.unused_data
+            if block:
+                decompressor = bz2.BZ2Decompressor()
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        # The end of the last stream was reached.
+        return
+    raise CompressedDataError("Truncated bz2 data")
+
+def _read_at_least(blocks, data, size):
+    """ Append blocks to ``data`` until it is ``size`` bytes long, or
+    the blocks are exhausted. """
+    while len(data) < size:
+        block = next(blocks, None)
+        if block is None:
+            break
+        data += block
+    return data
+
+def _unzip(blocks):
+    """ Decompress the first file of a zip archive, which is read from
+    its local file header on; the central directory at the end of the
+    archive is not needed. """
+    data = _read_at_least(blocks, '', _ZIP_HEADER.size)
+    if len(data) < _ZIP_HEADER.size:
+        raise CompressedDataError("Truncated zip archive")
+    (signature, version, flags, method, mtime, mdate, crc, compressed_size,
+     size, name_length, extra_length) = _ZIP_HEADER.unpack_from(data)
+    if signature != _ZIP_SIGNATURE:
+        raise CompressedDataError("Not a zip archive")
+    if flags & _ZIP_ENCRYPTED:
+        raise CompressedDataError("Encrypted zip archives are not supported")
+
+    start = _ZIP_HEADER.size + name_length + extra_length
+    data = _read_at_least(blocks, data, start)
+    rest = data[start:]
+    # CRC and size of the data yielded, which are checked against
+    # those recorded in the archive.
+    checksum = 0
+    length = 0
+
+    if method == _ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        for block in chain([rest], blocks):
+            for data in _inflate(decompressor, block, 'zip'):
+                checksum = zlib.crc32(data, checksum)
+                length += len(data)
+                yield data
+            if decompressor.unused_data:
+                break
+        rest = decompressor.unused_data
+        data = _finish(decompressor, 'zip')
+        if data:
+            checksum = zlib.crc32(data, checksum)
+            length += len(data)
+            yield data
+    elif method == _ZIP_STORED and not flags & _ZIP_DESCRIPTOR:
+        remaining = compressed_size
+        for block in chain([rest], blocks):
+            data = block[:remaining]
+            checksum = zlib.crc32(data, checksum)
+            length += len(data)
+            yield data
+            if len(block) >= remaining:
+                rest = block[remaining:]
+                break
+            remaining -= len(block)
+        else:
+            raise CompressedDataError("Truncated zip data")
+    else:
+        raise CompressedDataError("Unsupported zip compression method %d"
+                                  % method)
+
+    # Only a single file is read, so make sure there isn't another one.
+    skip = 0
+    if flags & _ZIP_DESCRIPTOR:
+        rest = _read_at_least(blocks, rest, 16)
+        skip = 16 if rest.startswith(_ZIP_DESCRIPTOR_SIGNATURE) else 12
+        if len(rest) < skip:
+            raise CompressedDataError("Truncated zip archive")
+        crc = struct.unpack_from('<I', rest, skip - 12)[0]
+        size = None
+    if (checksum & 0xffffffff) != crc or \
+            size not in (None, 0xffffffff) and length != size:
+        raise CompressedDataError("CRC or size of zip data does not match, "
+                                  "the archive is corrupt or truncated")
+    rest = _read_at_least(blocks, rest, skip + 4)
+    if rest[skip:skip + 4] == _ZIP_SIGNATURE:
+        raise CompressedDataError("Zip archives of more than one file are "
+                                  "not supported")
+
+_DECOMPRESSORS = {
+    'gzip': _gunzip,
+    'bz2': _bunzip2,
+    'zip': _unzip,
+}
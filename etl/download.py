@@ -0,0 +1,322 @@
+"""
+Parallel ranged downloads of large HTTP resources.
+
+A single connection to a slow server can take longer to download a data
+file than the import takes to load it. If the server accepts byte range
+requests, ``open_ranged`` downloads the resource as a number of ranges
+over several connections at once. The ranges are written to a spool
+file, which is read back in order as soon as the data is there, so the
+import starts with the first range rather than at the end of the
+download. A range whose connection breaks off is requested again from
+where it stopped.
+
+Resources on servers without range support, and small ones, are read
+through a single connection, by a ``ResumingReader``: if the connection
+breaks off, or ends before Content-Length bytes were read, the resource
+is requested again from the first byte not read yet.
+"""
+
+import httplib
+import logging
+import socket
+import tempfile
+import time
+import urllib2
+from collections import deque
+from threading import Condition, Thread
+
+log = logging.getLogger(__name__)
+
+# Number of connections a resource is downloaded with.
+CONNECTIONS = 4
+
+# Size of the ranges requested. Resources smaller than two ranges are
+# not worth splitting up.
+RANGE_SIZE = 8 * 1024 * 1024
+
+# Number of times a broken range is requested again before the download
+# is given up.
+RETRIES = 5
+
+# Size of the blocks data is read and downloaded in.
+BLOCK_SIZE = 64 * 1024
+
+# Errors of a connection which are worth another attempt.
+_NETWORK_ERRORS = (IOError, socket.error, httplib.HTTPException)
+
+
+class RangeNotSatisfiedError(IOError):
+    """ The server did not answer a range request with the range. """
+
+
+class IncompleteDownloadError(IOError):
+    """ A download broke off, and could not be resumed. """
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+def head(url):
+    """ Return the headers of the response to a HEAD request for
+    ``url``. """
+    fp = urllib2.urlopen(HeadRequest(url))
+    try:
+        return fp.info()
+    finally:
+        fp.close()
+
+def open_ranged(url, connections=CONNECTIONS, range_size=RANGE_SIZE,
+                spool_dir=None):
+    """ Open ``url`` for reading, downloading it in ranges over
+    ``connections`` connections if the server supports it. """
+    try:
+        headers = head(url)
+    except _NETWORK_ERRORS as e:
+        log.info("HEAD request for %s failed (%s), downloading it as a "
+                 "whole", url, e)
+        return open_resumable(url)
+
+    length = headers.get('content-length')
+    if 'bytes' not in headers.get('accept-ranges', '').lower() \
+            or not length or int(length) < 2 * range_size \
+            or headers.get('content-encoding'):
+        return open_resumable(url)
+
+    log.info("Downloading %s bytes of %s over %d connections", length, url,
+             connections)
+    return RangedReader(url, int(length), headers, connections, range_size,
+                        spool_dir)
+
+def open_resumable(url, retries=RETRIES):
+    """ Open ``url`` for reading through a single connection, which is
+    made again if it breaks off. """
+    return ResumingReader(url, urllib2.urlopen(url), retries)
+
+
+def _backoff(attempt):
+    time.sleep(min(0.5 * 2 ** attempt, 30))
+
+def _open_range(url, headers, first, last=''):
+    """ Request bytes ``first`` to ``last`` of ``url``, whose earlier
+    response had ``headers``. The request is conditional on the ETag or
+    Last-Modified date of that response, so that a RangeNotSatisfiedError
+    is raised rather than parts of two versions of the resource being
+    stitched together. """
+    request = urllib2.Request(url, headers={
+        'Range': 'bytes=%d-%s' % (first, last)})
+    validator = headers.get('etag') or headers.get('last-modified')
+    if validator:
+        request.add_header('If-Range', validator)
+    fp = urllib2.urlopen(request)
+    content_range = fp.info().get('content-range', '')
+    etag = fp.info().get('etag')
+    if fp.getcode() != 206 or \
+            not content_range.startswith('bytes %d-' % first) or \
+            etag and headers.get('etag') and etag != headers.get('etag'):
+        fp.close()
+        raise RangeNotSatisfiedError(
+            "Server did not return %s from byte %d on, or it has changed"
+            % (url, first))
+    return fp
+
+
+class ResumingReader(object):
+    """ File-like object reading the response ``fp`` to a request for
+    ``url``. If reading fails with a network error, or the response
+    ends short of its Content-Length, the rest of the resource is
+    requested with a Range header, up to ``retries`` times in a row,
+    waiting longer before each attempt. A resource which has changed
+    in the meantime is not stitched together with the old one.
+
+    If ``fp`` is the response to a range request, ``offset`` is the
+    byte of the resource it starts at. """
+
+    def __init__(self, url, fp, retries=RETRIES, offset=0):
+        self.url = url
+        self.fp = fp
+        self.retries = retries
+        self.position = offset
+        info = getattr(fp, 'info', None)
+        self.headers = info() if info is not None else {}
+        getcode = getattr(fp, 'getcode', None)
+        self.code = getcode() if getcode is not None else 200
+        length = self.headers.get('content-length')
+        self.length = offset + int(length) if length else None
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(BLOCK_SIZE), ''))
+        attempt = 0
+        while True:
+            try:
+                if self.fp is None:
+                    self.fp = self._reconnect()
+                data = self.fp.read(size)
+                if not data and size and self.length is not None \
+                        and self.position < self.length:
+                    raise IOError("connection closed")
+                self.position += len(data)
+                return data
+            except RangeNotSatisfiedError:
+                raise
+            except _NETWORK_ERRORS as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise IncompleteDownloadError(
+                        "Download of %s broke off after %d of %s bytes: %s"
+                        % (self.url, self.position, self.length or "?", e))
+                log.warn("Download of %s broke off at byte %d (%s), "
+                         "resuming", self.url, self.position, e)
+                self._close_response()
+                _backoff(attempt)
+
+    def _reconnect(self):
+        return _open_range(self.url, self.headers, self.position)
+
+    def _close_response(self):
+        fp, self.fp = self.fp, None
+        if fp is not None:
+            try:
+                fp.close()
+            except _NETWORK_ERRORS:
+                pass
+
+    def close(self):
+        self._close_response()
+
+
+class RangedReader(object):
+    """ File-like object reading a resource of ``length`` bytes, which
+    is downloaded in ranges of ``range_size`` bytes by ``connections``
+    threads. """
+
+    def __init__(self, url, length, headers, connections=CONNECTIONS,
+                 range_size=RANGE_SIZE, spool_dir=None, retries=RETRIES):
+        self.url = url
+        self.length = length
+        self.headers = headers
+        self.range_size = range_size
+        self.retries = retries
+        self.position = 0
+        self.closed = False
+        self.error = None
+
+        self.spool = tempfile.NamedTemporaryFile(prefix='download-',
+                                                 dir=spool_dir)
+        # Unbuffered, as a buffer could hold bytes of the spool file
+        # read before they were downloaded.
+        self.spool_reader = open(self.spool.name, 'rb', 0)
+        self.ranges = [(start, min(start + range_size, length))
+                       for start in xrange(0, length, range_size)]
+        # Number of bytes of each range in the spool file.
+        self.received = [0] * len(self.ranges)
+        # Ranges not started yet, in order, so that the range read next
+        # is always downloaded first.
+        self.pending = deque(xrange(len(self.ranges)))
+        self.condition = Condition()
+
+        self.threads = [Thread(target=self._download, name='download-%d' % i)
+                        for i in range(min(connections, len(self.ranges)))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return 200
+
+    def _download(self):
+        try:
+            with open(self.spool.name, 'r+b') as out:
+                while True:
+                    with self.condition:
+                        if self.closed or self.error or not self.pending:
+                            return
+                        index = self.pending.popleft()
+                    self._download_range(index, out)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def _download_range(self, index, out):
+        start, end = self.ranges[index]
+        attempt = 0
+        while True:
+            offset = start + self.received[index]
+            if offset >= end or self.closed:
+                return
+            try:
+                self._read_range(index, offset, end, out)
+            except RangeNotSatisfiedError:
+                raise
+            except _NETWORK_ERRORS as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log.warn("Download of bytes %d-%d of %s broke off at byte %d "
+                         "(%s), resuming", start, end - 1, self.url,
+                         start + self.received[index], e)
+                _backoff(attempt)
+
+    def _read_range(self, index, offset, end, out):
+        start = self.ranges[index][0]
+        fp = _open_range(self.url, self.headers, offset, end - 1)
+        try:
+            while offset < end and not self.closed:
+                data = fp.read(min(BLOCK_SIZE, end - offset))
+                if not data:
+                    raise IOError("connection closed")
+                out.seek(offset)
+                out.write(data)
+                out.flush()
+                offset += len(data)
+                with self.condition:
+                    self.received[index] = offset - start
+                    self.condition.notify_all()
+        finally:
+            fp.close()
+
+    def _available(self):
+        """ Wait until data at the current position has been downloaded,
+        and return the number of bytes available from there. """
+        index = self.position // self.range_size
+        start = self.ranges[index][0]
+        with self.condition:
+            while start + self.received[index] <= self.position:
+                if self.error is not None:
+                    raise self.error
+                self.condition.wait(1.0)
+            return start + self.received[index] - self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(BLOCK_SIZE), ''))
+        if self.position >= self.length or not size:
+            return ''
+        size = min(size, self._available())
+        self.spool_reader.seek(self.position)
+        data = self.spool_reader.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+        self.spool_reader.close()
+        self.spool.close()
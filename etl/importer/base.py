@@ -1,12 +1,25 @@
 import logging
+import hashlib
+from collections import deque
+from contextlib import contextmanager
+from threading import RLock
 
 from unidecode import unidecode
 
+from openspending.lib import json
 from openspending.lib import solr_util as solr
 from openspending.model import Dataset, meta as db
 
 from openspending.etl.validation import Invalid
-from openspending.etl.validation.types import convert_types
+from openspending.etl.validation.types import compile_mapping, invalid_row
+from openspending.etl.importer.parallel import convert_parallel, \
+    convert_partitions, convert_lines, blocks
+from openspending.etl.importer.pipeline import Fetcher, Writer
+from openspending.etl.importer.checkpoint import Checkpoint
+from openspending.etl.importer.errors import ErrorLog
+from openspending.etl.importer.fingerprint import FingerprintIndex, index_path
+from openspending.etl.importer.members import MemberTable, DimensionKeys
+from openspending.etl import util
 from openspending.etl import validation
 
 log = logging.getLogger(__name__)
@@ -31,11 +44,18 @@ class ModelValidationError(ImporterError):
 
 
 class DataError(ImporterError):
-    def __init__(self, exception, line_number=None, source_file=None):
+    def __init__(self, exception, line_number=None, source_file=None,
+                 offset=None):
         self.exception = exception
         self.line_number = line_number
         self.source_file = source_file
+        self.offset = offset
 
+    @property
+    def message(self):
+        # Formatted on demand, as most errors of a large import are
+        # never displayed.
+        exception = self.exception
         if isinstance(exception, Invalid):
             msgs = ["Validation error:"]
             for invalid in exception.children:
@@ -44,12 +64,30 @@ class DataError(ImporterError):
                 msg = msg % (invalid.node.name, invalid.datatype, 
                              invalid.column, invalid.value, invalid.msg)
                 msgs.append(msg)
-            self.message = "\n".join(msgs)
+            return "\n".join(msgs)
         elif isinstance(exception, Exception):
             # The message attribute is deprecated for Python 2.6 BaseExceptions.
-            self.message = str(exception)
+            return str(exception)
+        else:
+            return repr(exception)
+
+    def to_dict(self):
+        """ Structured form of the error, as written to error files. """
+        data = {'line_number': self.line_number,
+                'source_file': self.source_file}
+        if self.offset is not None:
+            data['offset'] = self.offset
+        if isinstance(self.exception, Invalid):
+            data['invalid'] = [{'attribute': invalid.column,
+                                'column': invalid.node.name,
+                                'datatype': invalid.datatype,
+                                'value': invalid.value,
+                                'message': invalid.msg,
+                                'template': invalid.template}
+                               for invalid in self.exception.children]
         else:
-            self.message = repr(exception)
+            data['message'] = self.message
+        return data
 
     def __str__(self):
         return "Line %s: %s" % (self.line_number, self.message)
@@ -69,8 +107,19 @@ class BaseImporter(object):
         self.model = model
         self.model_valid = None
         self.source_file = source_file
-        self.errors = []
+        self.errors = ErrorLog()
+        self.errors_lock = RLock()
         self.on_error = lambda e: log.warn(e)
+        self.stages = []
+        self.writer = None
+        self.checkpoint = None
+        self.skip_to_line = 0
+        self.fingerprints = None
+        self.aborted = False
+        self.overlong = None
+        self.skip_long_lines = False
+        self.tuple_rows = False
+        self.dimension_keys = None
 
     def run(self,
             dry_run=False,
@@ -78,40 +127,339 @@ class BaseImporter(object):
             max_lines=None,
             raise_errors=False,
             build_indices=True,
+            batch_size=None,
+            workers=None,
+            pipeline=False,
+            checkpoint=None,
+            resume=False,
+            checkpoint_interval=10000,
+            incremental=False,
+            fingerprint_dir=None,
+            error_file=None,
+            tuple_rows=False,
+            cache_sizes=None,
+            columnar=False,
+            dimension_keys=False,
+            max_line_length=util.MAX_LINE_LENGTH,
+            skip_long_lines=False,
             **kwargs):
 
         self.dry_run = dry_run
         self.max_errors = max_errors
         self.raise_errors = raise_errors
+        self.batch_size = batch_size
+        self.batch = []
+        self.tuple_rows = tuple_rows
+        self.worker_cache_stats = {}
 
+        # Of the model as given, before validation fills it in.
+        model_digest = self.model_digest()
         self.validate_model()
+        self.converter = compile_mapping(self.model['mapping'], cache_sizes)
+        # Members are only worth sharing between entries which are held
+        # in batches or queues before they are loaded.
+        self.members = None
+        if (batch_size and batch_size > 1) or pipeline or \
+                (workers and workers > 1):
+            self.members = MemberTable(self.converter.compounds)
         self.dataset = self.create_dataset(dry_run=dry_run)
         self.dataset.generate()
         #self.describe_dimensions()
 
+        self.dimension_keys = None
+        if dimension_keys and not dry_run:
+            self.dimension_keys = DimensionKeys(self.dataset,
+                                                self.converter.compounds)
+
         self.line_number = 0
+        self.truncated = False
+        self.checkpoint = None
+        self.skip_to_line = 0
+        self.aborted = False
+        first_line = 1
 
-        for line_number, line in enumerate(self.lines, start=1):
-            if max_lines and line_number > max_lines:
-                break
+        if checkpoint and not dry_run:
+            self.checkpoint = Checkpoint(checkpoint, self.resource_digest(),
+                                         checkpoint_interval, model_digest)
+            if resume:
+                first_line = self.resume()
 
-            self.line_number = line_number
-            self.process_line(line)
+        if error_file:
+            # The errors of the lines loaded before a resumed import are
+            # kept; otherwise those of an earlier import are replaced.
+            self.errors.open(error_file, append=bool(self.skip_to_line))
 
-        if self.line_number == 0:
+        self.fingerprints = None
+        if incremental:
+            self.fingerprints = self.open_fingerprints(fingerprint_dir)
+
+        self.limit_line_length(max_line_length, skip_long_lines)
+
+        if pipeline:
+            self.start_pipeline()
+
+        self.line_number = self.skip_to_line
+
+        try:
+            # Reads the header, which may fail the import.
+            lines = self.numbered_lines(first_line, max_lines)
+            if workers and workers > 1:
+                partitions = None
+                if not (max_lines or self.checkpoint or self.aborted):
+                    partitions = self.partitions(workers)
+                if partitions:
+                    self.process_partitions(partitions, workers, columnar)
+                else:
+                    self.process_parallel(lines, workers, columnar)
+            elif columnar:
+                self.process_columnar(lines)
+            else:
+                for line_number, line in lines:
+                    self.line_number = line_number
+                    self.process_line(line)
+        finally:
+            try:
+                self.stop_pipeline()
+                self.flush()
+            finally:
+                if self.dimension_keys is not None:
+                    self.dimension_keys.restore()
+
+        self.log_cache_stats()
+        if self.members is not None:
+            self.members.log_stats()
+
+        if self.fingerprints is not None:
+            # Entries of lines skipped on resume, cut off by max_lines,
+            # or which failed, were not fingerprinted; they would wrongly
+            # be reported and dropped as removed.
+            complete = not (self.skip_to_line or self.truncated or
+                            self.aborted or self.errors)
+            self.fingerprints.close(save=not dry_run, complete=complete)
+
+        if self.checkpoint:
+            self.checkpoint.remove()
+
+        if self.line_number == 0 and not self.aborted:
             self.add_error("Didn't read any lines of data")
 
         if self.errors:
             log.error("Finished import with %d errors:", len(self.errors))
-            for err in self.errors:
-                log.error(" - %s", err)
+            for line in self.errors.summary.lines():
+                log.error("  %s", line)
         else:
             log.info("Finished import with no errors!")
+        self.errors.close()
 
     @property
     def lines(self):
         raise NotImplementedError("lines not implemented in BaseImporter")
 
+    @property
+    def offset(self):
+        """ Number of bytes of the source read up to the end of the
+        current line, if known. """
+        return getattr(self.data, 'offset', None)
+
+    def numbered_lines(self, first_line, max_lines=None):
+        """ Return an iterator of ``(line_number, line)`` pairs,
+        starting at line ``first_line`` and skipping lines loaded before
+        the import was resumed. The source data is opened, and its
+        header read, right away. """
+        # Number of the last line read, including overlong lines which
+        # were skipped, see limit_line_length.
+        self.lines_read = first_line - 1
+        return self._numbered_lines(self.lines, first_line, max_lines)
+
+    def _numbered_lines(self, lines, first_line, max_lines):
+        if self.overlong is not None:
+            lines = self._with_overlong(lines)
+        for line in lines:
+            self.lines_read += 1
+            line_number = self.lines_read
+            if max_lines and line_number > max_lines:
+                self.truncated = True
+                break
+            if self.checkpoint and \
+                    line_number % self.checkpoint.interval == 0 and \
+                    not isinstance(line, util.OverlongLine):
+                # The offset is that of the line read after an overlong
+                # one, which is only counted afterwards.
+                self.checkpoint.mark(line_number, self.offset)
+            if line_number <= self.skip_to_line:
+                continue
+            yield line_number, line
+
+    def _with_overlong(self, lines):
+        """ Yield ``lines``, with an ``OverlongLine`` in place of each
+        line the reader skipped as too long, see limit_line_length. """
+        overlong = self.overlong
+        for line in lines:
+            while overlong:
+                yield util.OverlongLine(overlong.popleft())
+            yield line
+        while overlong:
+            yield util.OverlongLine(overlong.popleft())
+
+    def check_columns(self, header):
+        """ Check the header of the source data against the columns
+        used by the mapping, before any lines are read. If columns are
+        missing, a single error is added and False is returned, to
+        abort the import, or with ``raise_errors`` the error is raised. """
+        missing = self.converter.missing_columns(header)
+        if not missing:
+            return True
+        self.aborted = True
+        err = self.add_error("Columns used by the mapping do not exist in "
+                             "source data: %s"
+                             % ", ".join("'%s'" % c for c in missing))
+        if self.raise_errors:
+            raise err
+        return False
+
+    def partitions(self, parts):
+        """ Divide the source data into at least ``parts`` partitions,
+        which worker processes read themselves, see
+        ``openspending.etl.importer.partition``. Returns None if it can't
+        be divided. """
+        return None
+
+    def partition_converter(self):
+        """ The converter of the rows of partitions, which are lists of
+        cells. """
+        raise NotImplementedError("partition_converter not implemented "
+                                  "in BaseImporter")
+
+    def lines_from(self, offset, stops):
+        """ Yield the lines of the source data from byte ``offset``,
+        which is the end of a record, up to the first record which ends
+        at one of the offsets in ``stops``, or the end of the data. The
+        ``offset`` of the importer is then the end of the last record. """
+        raise NotImplementedError("lines_from not implemented in "
+                                  "BaseImporter")
+
+    def resource_digest(self):
+        """ Digest identifying the source data, which is stored in
+        checkpoints so that a changed source is not resumed. """
+        return None
+
+    def model_digest(self):
+        """ Digest of the model, which is stored in checkpoints so that
+        entries are not loaded under two different models. """
+        return hashlib.sha1(json.dumps(self.model, sort_keys=True)) \
+            .hexdigest()
+
+    def seek(self, offset):
+        """ Continue reading the source data from byte ``offset``, which
+        is the end of a line. Returns False if that is not possible. """
+        return False
+
+    def resume(self):
+        """ Continue from the saved checkpoint, if there is one, and
+        return the number of the first line to be read. """
+        state = self.checkpoint.load()
+        if state is None:
+            log.info("No checkpoint found, starting at line 1")
+            return 1
+        if state['resource'] != self.checkpoint.resource:
+            log.warn("Source data has changed since the checkpoint was "
+                     "saved, starting at line 1")
+            return 1
+        if state.get('model') != self.checkpoint.model:
+            log.warn("The model has changed since the checkpoint was "
+                     "saved, starting at line 1")
+            return 1
+
+        self.skip_to_line = state['line_number']
+        self.checkpoint.saved_line = state['line_number']
+        if state['offset'] is not None and self.seek(state['offset']):
+            log.info("Resuming after line %d, reading from byte %d",
+                     state['line_number'], state['offset'])
+            self.checkpoint.mark(state['offset_line'], state['offset'])
+            return state['offset_line'] + 1
+
+        log.info("Resuming after line %d, skipping lines already loaded",
+                 state['line_number'])
+        return 1
+
+    def open_fingerprints(self, directory=None):
+        """ Open the fingerprint index of the dataset, which is used to
+        skip entries that have not changed since the last import. """
+        unique_keys = self.model['dataset'].get('unique_keys')
+        if not unique_keys:
+            raise ImporterError("Incremental imports need the dataset's "
+                                "unique_keys to identify entries.")
+        name = self.model['dataset']['name']
+        fingerprints = FingerprintIndex(index_path(name, directory),
+                                        unique_keys)
+        if self.dataset_created:
+            # An index left over from an earlier dataset of the same
+            # name would make us skip entries that were never loaded.
+            fingerprints.clear()
+        return fingerprints
+
+    def limit_line_length(self, max_length, skip=False):
+        """ Stop reading lines of more than ``max_length`` bytes, so
+        that a source without line breaks is not buffered in memory as
+        a whole. A longer line is reported as an error with its byte
+        offset; the import is then aborted, or with ``skip`` continued
+        at the next line.
+
+        The reader may be well ahead of the lines being loaded, e.g.
+        when lines are converted in blocks. Overlong lines are thus
+        queued, and passed on as ``OverlongLine``\s in their place
+        among the lines, to be reported when their turn comes. They are
+        counted as lines, so that later lines keep their numbers; these
+        can't come from the LineReader, which counts physical lines,
+        not records. """
+        self.skip_long_lines = skip
+        self.overlong = None
+        if not isinstance(self.data, util.LineReader):
+            return
+
+        self.overlong = deque()
+        self.data.max_line_length = max_length
+        self.data.on_overlong = self.overlong.append
+
+    def report_overlong(self, line):
+        """ Report the ``OverlongLine`` in place of the current line,
+        aborting the import unless overlong lines are skipped. """
+        err = self.add_error(line.error, self.line_number, line.error.offset)
+        if not self.skip_long_lines:
+            self.aborted = True
+            raise err
+        self.skip_line()
+
+    def start_pipeline(self):
+        """ Read the source data and write to the database in
+        background threads, so that network, conversion and database
+        latency overlap. """
+        if isinstance(self.data, util.MappedLineReader):
+            # Lines are sliced out of the mapping as they are parsed;
+            # a reader thread would only add copies.
+            pass
+        elif isinstance(self.data, util.LineReader):
+            self.data.source = Fetcher(self.data.source, chunk_size=1)
+            self.stages.append(self.data.source)
+        else:
+            self.data = Fetcher(self.data)
+            self.stages.append(self.data)
+        if not self.dry_run:
+            self.writer = Writer(self.write).start()
+            self.stages.append(self.writer)
+
+    def stop_pipeline(self):
+        """ Wait for the writer to finish, re-raising any exception
+        which stopped it, and stop the other stages. """
+        try:
+            if self.writer is not None:
+                self.writer.close()
+        finally:
+            self.writer = None
+            for stage in self.stages:
+                stage.stop()
+            self.stages = []
+
     def validate_model(self):
         if self.model_valid:
             return
@@ -127,6 +475,7 @@ class BaseImporter(object):
         q = db.session.query(Dataset)
         q = q.filter_by(name=self.model['dataset']['name'])
         dataset = q.first()
+        self.dataset_created = dataset is None
         if dataset is not None:
             return dataset
         dataset = Dataset(self.model)
@@ -136,27 +485,232 @@ class BaseImporter(object):
             db.session.commit()
         return dataset
 
-    def process_line(self, line):
+    def log_progress(self):
         if self.line_number % 1000 == 0:
-            log.info('Imported %s lines' % self.line_number)
+            if self.stages:
+                log.info('Imported %s lines (queues: %s)', self.line_number,
+                         ", ".join(s.depth for s in self.stages))
+            else:
+                log.info('Imported %s lines' % self.line_number)
+
+    def cache_stats(self):
+        """ Return ``{datatype: (hits, misses)}`` for the conversion
+        caches, summed over all worker processes. """
+        totals = {}
+        for stats in [self.converter.cache_stats()] + \
+                self.worker_cache_stats.values():
+            for datatype, (hits, misses) in stats.items():
+                total = totals.get(datatype, (0, 0))
+                totals[datatype] = (total[0] + hits, total[1] + misses)
+        return totals
+
+    def log_cache_stats(self):
+        for datatype, (hits, misses) in sorted(self.cache_stats().items()):
+            if hits + misses:
+                log.info("Conversion cache for '%s' values: %d hits, %d "
+                         "misses (%.1f%% hit rate)", datatype, hits, misses,
+                         100.0 * hits / (hits + misses))
+
+    def process_line(self, line):
+        self.log_progress()
+        if isinstance(line, util.OverlongLine):
+            self.report_overlong(line)
+            return
 
         try:
-            data = convert_types(self.model['mapping'], line)
-            if not self.dry_run:
-                self.dataset.load(data)
-        except (Invalid, ImporterError) as e:
+            data = self.converter(line)
+        except Invalid as e:
             if self.raise_errors:
                 raise
             else:
                 self.add_error(e)
+                self.skip_line()
+        else:
+            self.process_entry(data)
+
+    def process_parallel(self, lines, workers, columnar=False):
+        """ Convert lines in a pool of ``workers`` processes, and load
+        the results here, in their original order. """
+        converted = convert_parallel(self.converter, lines, workers,
+                                     cache_stats=self.worker_cache_stats,
+                                     columnar=columnar)
+        for line_number, data, failures in converted:
+            self.line_number = line_number
+            self.log_progress()
+            self.process_converted(data, failures)
+
+    def process_partitions(self, partitions, workers, columnar=False):
+        """ Read and convert ``partitions`` of the source in a pool of
+        ``workers`` processes, and load the results here, in order. The
+        records of each partition are numbered on from those before it.
+        A partition which a worker could not read on its own is read
+        here, up to the next one that starts at the end of a record. """
+        converted = convert_partitions(self.partition_converter(),
+                                       partitions, workers,
+                                       getattr(self.data, 'max_line_length',
+                                               None),
+                                       cache_stats=self.worker_cache_stats,
+                                       columnar=columnar)
+        starts = set(partition.start for partition in partitions)
+        position = partitions[0].start
+        for partition, results in converted:
+            if partition.start != position:
+                # Read sequentially, along with a partition before it.
+                continue
+            if results is None:
+                lines = self._numbered_lines(
+                    self.lines_from(position, starts), None, None)
+                for line_number, line in lines:
+                    self.line_number = line_number
+                    self.process_line(line)
+                position = self.offset
+                continue
+            for line_number, data, failures in results:
+                self.line_number = self.lines_read + line_number
+                self.log_progress()
+                self.process_converted(data, failures)
+            self.lines_read += len(results)
+            position = partition.end
+
+    def process_columnar(self, lines, block_size=500):
+        """ Convert blocks of lines column by column, see
+        ``openspending.etl.validation.columnar``. """
+        for block in blocks(lines, block_size):
+            converted = convert_lines(self.converter, block, columnar=True)
+            for line_number, data, failures in converted:
+                self.line_number = line_number
+                self.log_progress()
+                self.process_converted(data, failures)
+
+    def process_converted(self, data, failures):
+        """ Load a line converted elsewhere, or report the InvalidData
+        errors it failed with. """
+        if isinstance(data, util.OverlongLine):
+            self.report_overlong(data)
+        elif failures is None:
+            self.process_entry(data)
+        elif self.raise_errors:
+            raise invalid_row(failures)
+        else:
+            self.add_error(invalid_row(failures))
+            self.skip_line()
+
+    def process_entry(self, data):
+        if self.fingerprints is not None and \
+                not self.fingerprints.changed(data):
+            self.skip_line()
+            return
+        if self.dry_run:
+            return
+        if self.members is not None:
+            data = self.members.encode(data)
+        self.queue(data)
+
+    def skip_line(self):
+        """ Pass on the current line, which has no entry to load, when
+        checkpointing, so that the checkpoint advances past it once the
+        entries before it are loaded. """
+        if self.checkpoint:
+            self.queue(None)
+
+    def queue(self, data):
+        if self.writer is not None:
+            self.writer.put(self.line_number, data)
+        else:
+            self.write(self.line_number, data)
+
+    def write(self, line_number, data):
+        """ Load the entry of line ``line_number``; with ``data`` None,
+        only record that the line is done. """
+        if self.batch_size:
+            self.batch.append((line_number, data))
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        else:
+            if data is not None:
+                self.load(line_number, data)
+            self.committed(line_number)
+
+    def committed(self, line_number):
+        if self.dimension_keys is not None:
+            self.dimension_keys.commit()
+        if self.checkpoint:
+            self.checkpoint.commit(line_number)
 
-    def add_error(self, exception):
+    def load(self, line_number, data):
+        try:
+            self.dataset.load(data)
+        except (Invalid, ImporterError) as e:
+            if self.fingerprints is not None:
+                self.fingerprints.forget(data)
+            if self.raise_errors:
+                raise
+            else:
+                self.add_error(e, line_number)
+
+    def flush(self):
+        """ Load all buffered entries within a single transaction. If
+        that fails, the transaction is rolled back and the entries are
+        loaded one by one, so that errors are reported against the
+        right line. """
+        batch, self.batch = self.batch, []
+        entries = [(line_number, data) for line_number, data in batch
+                   if data is not None]
+        if not batch:
+            return
+
+        try:
+            if entries:
+                with self.transaction():
+                    for line_number, data in entries:
+                        self.dataset.load(data)
+        except Exception as e:
+            log.warn("Loading lines %d to %d failed (%s), retrying line "
+                     "by line", entries[0][0], entries[-1][0], e)
+            if self.dimension_keys is not None:
+                self.dimension_keys.rollback()
+
+            for line_number, data in entries:
+                self.load(line_number, data)
+
+        self.committed(batch[-1][0])
+
+    @contextmanager
+    def transaction(self):
+        """ Point the dataset at a connection with an open transaction
+        for the duration of the block, so that all loads within it are
+        committed together. """
+        bind = self.dataset.bind
+        conn = bind.connect()
+        trans = conn.begin()
+        self.dataset.bind = conn
+        try:
+            yield conn
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            self.dataset.bind = bind
+            conn.close()
+
+    def add_error(self, exception, line_number=None, offset=None):
+        if line_number is None:
+            line_number = self.line_number
         err = DataError(exception=exception,
-                        line_number=self.line_number,
-                        source_file=self.source_file)
-        self.on_error(err)
-        self.errors.append(err)
-
-        if self.max_errors and len(self.errors) >= self.max_errors:
-            all_errors = "".join(map(lambda x: "\n  " + str(x), self.errors))
-            raise TooManyErrorsError("The following errors occurred:" + all_errors)
+                        line_number=line_number,
+                        source_file=self.source_file,
+                        offset=offset)
+        with self.errors_lock:
+            # Only the first few errors of each kind are reported as
+            # they happen, the rest show up in the summary.
+            if self.errors.append(err):
+                self.on_error(err)
+
+            if self.max_errors and len(self.errors) >= self.max_errors:
+                all_errors = "".join(map(lambda x: "\n  " + str(x), self.errors))
+                if self.errors.dropped:
+                    all_errors += "\n  (and %d earlier errors)" \
+                        % self.errors.dropped
+                raise TooManyErrorsError("The following errors occurred:" + all_errors)
+        return err
@@ -0,0 +1,82 @@
+"""
+Checkpoints for resuming interrupted imports.
+
+A checkpoint records the last line whose entry has been committed to
+the database, together with the byte offset of a record boundary at or
+before that line and digests of the source and of the model. An import
+which is restarted with the same checkpoint file, source and model can
+then continue reading the source from that offset, and skip the lines
+between there and the last committed line. Lines which failed, or had
+no entry to load, count as committed once the lines before them are.
+"""
+
+import logging
+import os
+from collections import deque
+
+from openspending.lib import json
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+
+    def __init__(self, path, resource=None, interval=10000, model=None):
+        self.path = path
+        self.resource = resource
+        self.model = model
+        self.interval = interval
+        self.marks = deque()
+        self.saved_line = 0
+
+    def load(self):
+        """ Return the saved checkpoint as a dict, or None if there
+        is none. """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def mark(self, line_number, offset):
+        """ Record that line ``line_number`` ends at byte ``offset`` of
+        the source. Called by the reading side of the import. """
+        self.marks.append((line_number, offset))
+
+    def commit(self, line_number):
+        """ Record that all lines up to ``line_number`` have been
+        loaded, saving a checkpoint every ``interval`` lines. Called by
+        the writing side of the import. """
+        if line_number - self.saved_line < self.interval:
+            return
+
+        while len(self.marks) > 1 and self.marks[1][0] <= line_number:
+            self.marks.popleft()
+        if self.marks and self.marks[0][0] <= line_number:
+            offset_line, offset = self.marks[0]
+        else:
+            offset_line, offset = 0, None
+
+        self.save({
+            'line_number': line_number,
+            'offset_line': offset_line,
+            'offset': offset,
+            'resource': self.resource,
+            'model': self.model
+        })
+        self.saved_line = line_number
+
+    def save(self, state):
+        """ Write ``state`` to a temporary file which is synced to disk
+        and then moved over the checkpoint, so that there is always a
+        complete checkpoint on disk. """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        log.debug("Saved checkpoint at line %d", state['line_number'])
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -170,7 +170,7 @@ class CKANImporter(CSVImporter):
             model_url = model['url']
 
 
-        model_fp = util.urlopen(model_url)
+        model_fp = util.open_url(model_url)
         try:
             model = json.load(model_fp)
         except Exception as e:
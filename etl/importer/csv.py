@@ -1,14 +1,101 @@
+from __future__ import absolute_import
+
+import csv
+
 from openspending.lib import unicode_dict_reader as udr
 
+from openspending.etl import util
 from openspending.etl.importer.base import BaseImporter
+from openspending.etl.importer.partition import partition_csv
 
 class CSVImporter(BaseImporter):
 
+    encoding = 'utf8'
+
     @property
     def lines(self):
-        try:
-            return udr.UnicodeDictReader(self.data)
-        except udr.EmptyCSVError as e:
-            self.add_error(e)
+        reader = csv.reader(self.data)
+        header = next(reader, None)
+        if not header:
+            self.add_error(udr.EmptyCSVError("No fieldnames in CSV reader: "
+                                             "empty file?"))
             return ()
 
+        header = [f.decode(self.encoding) for f in header]
+        self.header = header
+        if not self.check_columns(header):
+            return ()
+
+        if self.tuple_rows:
+            # Rows are passed on as lists of byte strings, and the
+            # converter decodes the cells it reads.
+            self.converter = self.converter.bind(header, self.encoding)
+            return (row for row in reader if row)
+        return self.dict_rows(reader, header)
+
+    def dict_rows(self, reader, header):
+        """ Yield rows as dicts of the columns used by the mapping. The
+        other columns are not decoded, and are left out. Like
+        ``csv.DictReader``, blank lines are skipped and cells missing
+        from short rows are None. """
+        index = dict((column, i) for i, column in enumerate(header))
+        columns = [(column, index[column])
+                   for column in self.converter.columns]
+        encoding = self.encoding
+
+        for row in reader:
+            if not row:
+                continue
+            length = len(row)
+            yield dict((column, row[i].decode(encoding) if i < length else None)
+                       for column, i in columns)
+
+    def partitions(self, parts):
+        if self.source_file == "<stream>":
+            return None
+        return partition_csv(self.source_file, parts)
+
+    def partition_converter(self):
+        if self.tuple_rows:
+            return self.converter
+        return self.converter.bind(self.header, self.encoding)
+
+    def lines_from(self, offset, stops):
+        data = util.urlopen_lines(
+            self.source_file, offset,
+            max_line_length=getattr(self.data, 'max_line_length', None),
+            on_overlong=getattr(self.data, 'on_overlong', None))
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+        self.data = data
+        reader = csv.reader(data)
+        if self.tuple_rows:
+            rows = (row for row in reader if row)
+        else:
+            rows = self.dict_rows(reader, self.header)
+        for row in rows:
+            yield row
+            if data.offset in stops:
+                break
+
+    def resource_digest(self):
+        if self.source_file == "<stream>":
+            return None
+        return util.resource_digest(self.source_file)
+
+    def seek(self, offset):
+        if self.source_file == "<stream>":
+            return False
+        # Keep the header line, so that it is read again before the
+        # rows.
+        header = next(iter(self.data), None)
+        if header is None:
+            return False
+        # Stop reading the source from the start, which with a ranged
+        # download would otherwise go on in the background.
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+        self.data = util.urlopen_lines(self.source_file, offset, [header])
+        return True
@@ -0,0 +1,242 @@
+"""
+Bounded storage for import errors.
+
+A badly mapped file can fail on every one of its lines, so an import
+keeps only a ring of its most recent errors in memory, together with
+their total count and a summary which groups similar errors. All
+errors can additionally be streamed to a file, one JSON
+record per line. The summary is then saved next to it whenever the file
+is flushed, so that it can be shown without reading all errors back.
+"""
+
+import os
+import time
+from collections import deque
+
+from openspending.lib import json
+from openspending.etl.validation import Invalid
+
+# Number of errors kept in memory by default.
+KEEP = 1000
+
+# Number of sample errors kept for each group of a summary.
+SAMPLES = 3
+
+# Maximum number of groups in a summary. Further errors are counted
+# as "other errors".
+MAX_GROUPS = 100
+
+# Number of errors written to the error file between flushes, and the
+# longest time in seconds between them.
+FLUSH_INTERVAL = 100
+FLUSH_SECONDS = 5
+
+
+def summary_path(path):
+    """ Path of the summary saved with the error file ``path``. """
+    return path + '.summary'
+
+
+class ErrorLog(object):
+    """ A list-like collection of ``DataError``\s. ``len()`` is the
+    total number of errors added, while iterating and indexing only
+    see the ``keep`` most recent ones. """
+
+    def __init__(self, keep=KEEP, path=None):
+        self.recent = deque(maxlen=keep)
+        self.count = 0
+        self.summary = ErrorSummary()
+        self.sink = None
+        self.flushed = 0
+        if path:
+            self.open(path)
+
+    @property
+    def dropped(self):
+        """ Number of errors no longer kept in memory. """
+        return self.count - len(self.recent)
+
+    def open(self, path, append=False):
+        """ Write all errors added from now on to the file ``path``,
+        replacing the errors of an earlier import. With ``append``, as
+        when the import is resumed, they are added to those, and the
+        summary saved with the file, if any, is continued. """
+        self.close()
+        if append and os.path.exists(summary_path(path)):
+            self.summary = ErrorSummary.load(summary_path(path))
+        else:
+            self.summary = ErrorSummary()
+        self.sink = open(path, 'a' if append else 'w')
+        # Replace the summary of an earlier import right away.
+        self.flush()
+
+    def append(self, error):
+        """ Add an error. Returns True if it is one of the samples of
+        the summary, i.e. worth showing on its own. """
+        self.count += 1
+        self.recent.append(error)
+        sampled = self.summary.add_error(error)
+        if self.sink is not None:
+            self.sink.write(json.dumps(error.to_dict()) + '\n')
+            if self.count % FLUSH_INTERVAL == 0 or \
+                    time.time() - self.flushed > FLUSH_SECONDS:
+                self.flush()
+        return sampled
+
+    def flush(self):
+        """ Write buffered errors to the error file, and save the
+        summary with it. """
+        if self.sink is not None:
+            self.sink.flush()
+            self.summary.save(summary_path(self.sink.name))
+            self.flushed = time.time()
+
+    def close(self):
+        if self.sink is not None:
+            self.flush()
+            self.sink.close()
+            self.sink = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.recent)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.recent)[index]
+        return self.recent[index]
+
+    def __eq__(self, other):
+        return self.dropped == 0 and list(self.recent) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ErrorLog(count=%d, %r)>' % (self.count, list(self.recent))
+
+
+class ErrorSummary(object):
+    """ Errors grouped by attribute, data type, column and message
+    template, with the number of errors and a few sample line numbers
+    and values for each group. Groups are shown with the message of
+    their first error, which is only formatted when it is shown. Errors
+    are added as ``DataError``\s, or as the records of an error file
+    (see ``DataError.to_dict``). """
+
+    def __init__(self, samples=SAMPLES, max_groups=MAX_GROUPS):
+        self.samples = samples
+        self.max_groups = max_groups
+        self.groups = {}
+        self.other = 0
+
+    def add(self, record):
+        """ Add an error record, returning True if it was kept as a
+        sample of any group. """
+        return self._add(self._group_keys(record), record['line_number'])
+
+    def add_error(self, error):
+        """ Add a ``DataError``, see ``add``. """
+        return self._add(self._error_keys(error), error.line_number)
+
+    def _add(self, keys, line_number):
+        sampled = False
+        for key, value, message in keys:
+            group = self.groups.get(key)
+            if group is None:
+                if len(self.groups) >= self.max_groups:
+                    self.other += 1
+                    continue
+                group = self.groups[key] = {'count': 0, 'samples': [],
+                                            'message': message}
+            group['count'] += 1
+            if len(group['samples']) < self.samples:
+                group['samples'].append((line_number, value))
+                sampled = True
+        return sampled
+
+    def _group_keys(self, record):
+        if 'invalid' in record:
+            for invalid in record['invalid']:
+                key = (invalid['attribute'], invalid['datatype'],
+                       invalid['column'],
+                       invalid.get('template') or invalid['message'])
+                yield key, invalid['value'], invalid['message']
+        else:
+            yield (None, None, None, record['message']), None, \
+                record['message']
+
+    def _error_keys(self, error):
+        # Messages of invalid values are passed on unformatted.
+        if isinstance(error.exception, Invalid):
+            for invalid in error.exception.children:
+                key = (invalid.column, invalid.datatype, invalid.node.name,
+                       getattr(invalid, 'template', None) or invalid.msg)
+                yield key, invalid.value, invalid
+        else:
+            message = error.message
+            yield (None, None, None, message), None, message
+
+    def message(self, group):
+        """ The message of a group, formatted on first use. """
+        message = group['message']
+        if isinstance(message, Invalid):
+            message = group['message'] = message.msg
+        return message
+
+    def lines(self):
+        """ Format the summary, largest groups first. """
+        groups = sorted(self.groups.items(), key=lambda item: -item[1]['count'])
+        for (attribute, datatype, column, template), group in groups:
+            if attribute is None:
+                yield "%d x %s" % (group['count'], self.message(group))
+                lines = ", ".join(str(l) for l, v in group['samples'])
+                yield "  e.g. line %s" % lines
+            else:
+                yield "%d x '%s' (%s) from column '%s': %s" \
+                      % (group['count'], attribute, datatype, column,
+                         self.message(group))
+                for line_number, value in group['samples']:
+                    yield "  e.g. line %s (value: %s)" % (line_number, value)
+        if self.other:
+            yield "%d other errors" % self.other
+
+    def save(self, path):
+        """ Save the summary as JSON to ``path``, through a temporary
+        file, so that a reader never sees a partly written summary. """
+        groups = [{'key': key, 'count': group['count'],
+                   'samples': group['samples'],
+                   'message': self.message(group)}
+                  for key, group in self.groups.items()]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'groups': groups, 'other': self.other}, f)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Return the summary saved to ``path``. """
+        with open(path) as f:
+            data = json.load(f)
+        summary = cls()
+        summary.other = data['other']
+        for group in data['groups']:
+            key = tuple(group.pop('key'))
+            group['samples'] = [tuple(s) for s in group['samples']]
+            summary.groups[key] = group
+        return summary
+
+    def __unicode__(self):
+        return u"\n".join(self.lines())
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def read_errors(path):
+    """ Yield the error records saved by an ``ErrorLog`` to ``path``. """
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
@@ -0,0 +1,139 @@
+"""
+Fingerprints of imported entries, for incremental imports.
+
+For each dataset, an index maps the key of every entry (built from the
+model's ``unique_keys``) to a fingerprint of its converted values. When
+the same source is imported again, entries whose fingerprint has not
+changed are not loaded, and keys that were not seen again are reported
+as removed.
+
+The index is a SQLite database. Changes to it are only committed when
+the import finishes, so an aborted import leaves the previous index in
+place.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+from threading import Lock
+
+from openspending.lib.util import hash_values
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(sys.prefix, 'var', 'lib', 'openspendingetld',
+                           'fingerprints')
+
+# Number of removed entry keys listed in the import log.
+REMOVED_SHOWN = 20
+
+
+def index_path(dataset_name, directory=None):
+    return os.path.join(directory or DEFAULT_DIR,
+                        '%s.fingerprints' % dataset_name)
+
+def remove_index(dataset_name, directory=None):
+    path = index_path(dataset_name, directory)
+    if os.path.exists(path):
+        os.remove(path)
+
+def _flatten(data, prefix=''):
+    for name, value in sorted(data.items()):
+        if isinstance(value, dict):
+            for item in _flatten(value, prefix + name + '.'):
+                yield item
+        else:
+            yield '%s%s=%r' % (prefix, name, value)
+
+def fingerprint(data):
+    """ Return a digest of all converted values of an entry. """
+    return hash_values(_flatten(data))
+
+
+class FingerprintIndex(object):
+
+    def __init__(self, path, unique_keys):
+        self.path = path
+        self.unique_keys = [k.split('.', 1) for k in unique_keys]
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        self.lock = Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS fingerprint ("
+                        "key TEXT PRIMARY KEY, label TEXT, "
+                        "fingerprint TEXT, seen INTEGER)")
+        self.db.execute("UPDATE fingerprint SET seen = 0")
+
+    def key(self, data):
+        values = []
+        for path in self.unique_keys:
+            value = data
+            for name in path:
+                value = value[name]
+            values.append(unicode(value))
+        return hash_values(values), u'/'.join(values)
+
+    def changed(self, data):
+        """ Record the fingerprint of ``data`` and return True if the
+        entry is new or has changed since the last import. """
+        key, label = self.key(data)
+        digest = fingerprint(data)
+        with self.lock:
+            row = self.db.execute("SELECT fingerprint FROM fingerprint "
+                                  "WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO fingerprint "
+                            "VALUES (?, ?, ?, 1)", (key, label, digest))
+        if row is None:
+            self.counts['new'] += 1
+        elif row[0] != digest:
+            self.counts['changed'] += 1
+        else:
+            self.counts['unchanged'] += 1
+            return False
+        return True
+
+    def forget(self, data):
+        """ Drop an entry which could not be loaded, so that it is
+        loaded again by the next import. """
+        key, label = self.key(data)
+        with self.lock:
+            self.db.execute("DELETE FROM fingerprint WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM fingerprint")
+
+    def close(self, save=True, complete=True):
+        """ Save the index unless ``save`` is False. If the import was
+        ``complete``, having read every line of the source without
+        errors, the keys which were not seen are removed and logged as
+        removed entries; otherwise they are kept, as they may only not
+        have been reached. """
+        removed = []
+        with self.lock:
+            if complete:
+                removed = self.db.execute("SELECT label FROM fingerprint "
+                                          "WHERE seen = 0").fetchall()
+            if save:
+                if complete:
+                    self.db.execute("DELETE FROM fingerprint WHERE seen = 0")
+                self.db.commit()
+            self.db.close()
+        self.removed = len(removed)
+
+        log.info("Incremental import: %(new)d new, %(changed)d changed and "
+                 "%(unchanged)d unchanged entries", self.counts)
+        if not complete:
+            log.info("Not checking for removed entries, as the import did "
+                     "not read all of the source without errors")
+        if removed:
+            log.warn("%d entries are no longer in the source data and have "
+                     "not been removed from the dataset:", len(removed))
+            for label, in removed[:REMOVED_SHOWN]:
+                log.warn(" - %s", label)
+            if len(removed) > REMOVED_SHOWN:
+                log.warn(" - ... and %d more", len(removed) - REMOVED_SHOWN)
@@ -0,0 +1,120 @@
+"""
+Shared members of compound dimensions, and the keys they were loaded
+with.
+
+Converted entries hold one dict per compound dimension, and the same
+few thousand members (departments, suppliers, regions) come up again
+and again. A ``MemberTable`` dictionary-encodes them: all entries with
+the same member of a dimension get the same dict, so that entries
+waiting in batches or queues don't each carry a copy. Encoded entries
+must therefore not be modified in place.
+
+``DimensionKeys`` remembers what loading each member into its
+dimension table returned, so that a member is only looked up or
+written once per import, rather than once per entry.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Maximum number of distinct members kept. Further members are not
+# shared.
+MAX_MEMBERS = 100000
+
+
+def member_key(dimension, member):
+    """ Key identifying a member of ``dimension`` by all its attribute
+    values. """
+    return (dimension, tuple(sorted(member.iteritems())))
+
+
+class MemberTable(object):
+
+    def __init__(self, dimensions, max_members=MAX_MEMBERS):
+        self.dimensions = list(dimensions)
+        self.max_members = max_members
+        self.members = {}
+        self.hits = 0
+
+    def encode(self, data):
+        """ Replace the compound dimension members of the converted
+        entry ``data`` by their shared copies, and return it. """
+        members = self.members
+        for dimension in self.dimensions:
+            member = data.get(dimension)
+            if member is None:
+                continue
+            key = member_key(dimension, member)
+            shared = members.get(key)
+            if shared is not None:
+                data[dimension] = shared
+                self.hits += 1
+            elif len(members) < self.max_members:
+                members[key] = member
+        return data
+
+    def log_stats(self):
+        if self.members:
+            log.info("Entries share %d distinct dimension members (%d "
+                     "repeated members shared)", len(self.members), self.hits)
+
+
+class DimensionKeys(object):
+    """ Memoizes the ``load`` method of the compound dimensions of a
+    dataset for the duration of an import. The first time a member is
+    loaded, it is written to the dimension table as usual; the result,
+    i.e. the keys the entry refers to the member by, is kept and used
+    for all further entries with the same member.
+
+    Members loaded within a database transaction have to be dropped
+    from the map if it is rolled back, see ``commit`` and
+    ``rollback``. """
+
+    def __init__(self, dataset, dimensions, max_members=MAX_MEMBERS):
+        self.max_members = max_members
+        self.keys = {}
+        self.pending = []
+        self.hits = 0
+        self.wrapped = []
+        for dimension in dataset.dimensions:
+            if dimension.name in dimensions:
+                self._wrap(dimension)
+
+    def _wrap(self, dimension):
+        load = dimension.load
+
+        def load_once(bind, row):
+            key = member_key(dimension.name, row)
+            result = self.keys.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+            result = load(bind, row)
+            if len(self.keys) < self.max_members:
+                self.keys[key] = result
+                self.pending.append(key)
+            return result
+
+        dimension.load = load_once
+        self.wrapped.append(dimension)
+
+    def commit(self):
+        """ The members loaded so far have been committed. """
+        self.pending = []
+
+    def rollback(self):
+        """ The members loaded since the last commit were rolled back,
+        and have to be loaded again. """
+        for key in self.pending:
+            self.keys.pop(key, None)
+        self.pending = []
+
+    def restore(self):
+        """ Remove the memoization from the dimensions. """
+        for dimension in self.wrapped:
+            del dimension.load
+        self.wrapped = []
+        if self.keys:
+            log.info("Loaded %d distinct dimension members, reused their "
+                     "keys %d times", len(self.keys), self.hits)
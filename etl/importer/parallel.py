@@ -0,0 +1,168 @@
+"""
+Conversion of source lines in a pool of worker processes.
+
+The reader and the writer stay in the importing process: numbered lines
+are cut into blocks, each block is converted by a worker with its own
+copy of the compiled mapping, and the results are handed back in the
+order the blocks were read. Only a bounded number of blocks is in
+flight at any time, so a slow writer throttles the reader.
+
+A CSV file divided into partitions (see
+``openspending.etl.importer.partition``) is instead read by the workers
+as well, each parsing and converting a partition of it at a time.
+"""
+
+import logging
+import os
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+from openspending.etl.importer.partition import PartitionError
+from openspending.etl.util import OverlongLine
+from openspending.etl.validation import Invalid
+from openspending.etl.validation.columnar import convert_block
+
+log = logging.getLogger(__name__)
+
+# The compiled mapping of the current worker process, whether it
+# converts blocks column by column, and the longest line it reads from
+# a partition, see _init_worker.
+_converter = None
+_columnar = False
+_max_line_length = None
+
+
+def _init_worker(converter, columnar=False, max_line_length=None):
+    global _converter, _columnar, _max_line_length
+    _converter = converter
+    _columnar = columnar
+    _max_line_length = max_line_length
+
+def convert_lines(converter, block, columnar=False):
+    """ Convert a block of ``(line_number, line)`` pairs with
+    ``converter``, returning a list of ``(line_number, data,
+    failures)``. Failures are returned as the list of InvalidData
+    children rather than the aggregate exception, as only the former
+    survive pickling. An ``OverlongLine`` is returned as the data of
+    its line, for the importer to report in turn. With ``columnar``,
+    the block is converted column by column. """
+    if columnar:
+        lines = [line for n, line in block
+                 if not isinstance(line, OverlongLine)]
+        converted = iter(convert_block(converter, lines))
+        results = []
+        for line_number, line in block:
+            if isinstance(line, OverlongLine):
+                results.append((line_number, line, None))
+            else:
+                data, failures = next(converted)
+                results.append((line_number, data, failures))
+        return results
+
+    results = []
+    for line_number, line in block:
+        if isinstance(line, OverlongLine):
+            results.append((line_number, line, None))
+            continue
+        try:
+            results.append((line_number, converter(line), None))
+        except Invalid as e:
+            results.append((line_number, None, e.children))
+    return results
+
+def _convert_block(block):
+    """ Convert a block of lines, see convert_lines, returning the
+    process id and conversion cache statistics of the worker along
+    with the results. """
+    return (os.getpid(), _converter.cache_stats(),
+            convert_lines(_converter, block, _columnar))
+
+def _convert_partition(partition):
+    """ Read the rows of a partition, and convert them as a block
+    numbered from 1, see _convert_block. The results are None if the
+    partition can't be read on its own. """
+    try:
+        rows = partition.rows(_max_line_length)
+    except PartitionError as e:
+        log.info("%s, reading it sequentially", e)
+        return os.getpid(), _converter.cache_stats(), None
+    return _convert_block(list(enumerate(rows, 1)))
+
+def blocks(numbered_lines, block_size):
+    while True:
+        block = list(islice(numbered_lines, block_size))
+        if not block:
+            return
+        yield block
+
+def _results(async_result, cache_stats):
+    pid, stats, results = async_result.get()
+    if cache_stats is not None:
+        cache_stats[pid] = stats
+    return results
+
+def _ordered(pool, function, items, in_flight, cache_stats):
+    """ Yield ``(item, results)`` for each of ``items``, in order, as
+    returned by ``function`` in the pool, with at most ``in_flight``
+    items pending. """
+    pending = deque()
+    for item in items:
+        pending.append((item, pool.apply_async(function, (item,))))
+        if len(pending) >= in_flight:
+            item, result = pending.popleft()
+            yield item, _results(result, cache_stats)
+    while pending:
+        item, result = pending.popleft()
+        yield item, _results(result, cache_stats)
+
+def convert_parallel(converter, numbered_lines, workers,
+                     block_size=500, blocks_in_flight=None, cache_stats=None,
+                     columnar=False):
+    """ Yield ``(line_number, data, failures)`` for each of the
+    ``(line_number, line)`` pairs in ``numbered_lines``, in input order,
+    as converted by ``converter`` (a compiled mapping). ``failures`` is
+    None for lines that converted cleanly. If a ``cache_stats`` dict is
+    given, it is updated with the cache statistics of each worker, by
+    process id. With ``columnar``, blocks are converted column by
+    column, see ``openspending.etl.validation.columnar``. """
+    if blocks_in_flight is None:
+        blocks_in_flight = 2 * workers
+
+    log.info("Converting lines in %d worker processes", workers)
+    pool = Pool(workers, _init_worker, (converter, columnar))
+    try:
+        converted = _ordered(pool, _convert_block,
+                             blocks(numbered_lines, block_size),
+                             blocks_in_flight, cache_stats)
+        for block, results in converted:
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def convert_partitions(converter, partitions, workers, max_line_length=None,
+                       partitions_in_flight=None, cache_stats=None,
+                       columnar=False):
+    """ Yield ``(partition, results)`` for each of ``partitions``, in
+    order, read and converted by ``converter``, which takes rows as
+    lists of cells. ``results`` are as yielded by ``convert_parallel``
+    for the records of the partition, numbered from 1, or None if the
+    partition can't be read on its own and has to be read sequentially.
+    ``cache_stats`` and ``columnar`` are as for ``convert_parallel``. """
+    if partitions_in_flight is None:
+        partitions_in_flight = 2 * workers
+
+    log.info("Reading and converting %d partitions in %d worker "
+             "processes", len(partitions), workers)
+    pool = Pool(workers, _init_worker, (converter, columnar, max_line_length))
+    try:
+        for result in _ordered(pool, _convert_partition, partitions,
+                               partitions_in_flight, cache_stats):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,155 @@
+"""
+Division of a CSV file into byte ranges for parallel workers.
+
+A worker given a byte range of the source reads and parses its lines
+itself, so that reading is spread over the workers rather than done by
+the importing process alone. Ranges have to start at the beginning of a
+record; a line break inside a quoted field is not one. Where to cut is
+guessed from the parity of the number of quote characters before a
+line break, as an escaped quote is written as two of them. Quotes and
+line breaks are counted a block at a time in C, so the file is divided
+at about the speed it can be read, without parsing it.
+
+The guess goes wrong after a quote in the middle of an unquoted field,
+which the csv module reads as an ordinary character. A worker thus also
+checks that its range ends at the end of a record, see
+``Partition.rows``; if it does not, the importer reads on from the start
+of the range itself, up to the next range found to start at the end of
+a record. Line breaks are only ever cut at LF, so a file with CR line
+endings only comes out as a single range.
+
+Where the records of a range stand in the file is only known once the
+ranges before it have been parsed, so ranges do not carry line numbers:
+the importer numbers the records of each range on from those before it,
+as it does when reading the file as a whole.
+"""
+
+from __future__ import absolute_import
+
+import csv
+import logging
+from itertools import chain
+
+from openspending.etl import util
+
+log = logging.getLogger(__name__)
+
+# Size of the blocks quotes and line breaks are counted in.
+BLOCK_SIZE = 16 * util.BLOCK_SIZE
+
+# Largest size of a range, so that the records of a range can be held
+# in memory, and there are enough of them to keep the workers busy.
+PARTITION_SIZE = 4 * BLOCK_SIZE
+
+# Line parsed after the lines of a range. It comes out as a record of
+# its own only if the range ends at the end of a record; otherwise it
+# ends up in the quoted field left open.
+_SENTINEL = '\x1eend of partition\x1e'
+
+
+class PartitionError(ValueError):
+    """ The records of a partition can't be read on their own. """
+
+
+class Partition(object):
+    """ Bytes ``start`` to ``end`` of the CSV file at ``path``, whose
+    first record has the column names ``header``. ``start`` is taken to
+    be the end of a record. Partitions are pickled to be sent to worker
+    processes, and map the file again there. """
+
+    def __init__(self, path, start, end, header):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.header = header
+
+    def __repr__(self):
+        return "<Partition %s bytes %d-%d>" % (self.path, self.start,
+                                               self.end)
+
+    def lines(self, max_line_length=None):
+        """ Return a LineReader of the lines of the range. """
+        mapping = util.map_file(self.path)
+        blocks = util.mapped_blocks(mapping, self.start, self.end)
+        return util.LineReader(blocks, self.start,
+                               max_line_length=max_line_length)
+
+    def rows(self, max_line_length=None):
+        """ Return the rows of the records of the range, skipping blank
+        lines as the importer does. Raises a PartitionError if the range
+        does not end at the end of a record, or the records can't be
+        read as they would be from the whole file: they are cut short
+        by an error, or a line is longer than ``max_line_length``. """
+        lines = self.lines(max_line_length)
+        try:
+            rows = list(csv.reader(chain(lines, [_SENTINEL + '\n'])))
+        except (csv.Error, util.LineTooLongError) as e:
+            raise PartitionError("Can't read %r: %s" % (self, e))
+        finally:
+            lines.close()
+        if not rows or rows.pop() != [_SENTINEL]:
+            raise PartitionError("%r does not end at the end of a record"
+                                 % self)
+        return [row for row in rows if row]
+
+
+def _count(mapping, start, end, char):
+    return sum(block.count(char) for block in
+               util.mapped_blocks(mapping, start, end, BLOCK_SIZE))
+
+def partition_csv(url, parts, max_size=PARTITION_SIZE):
+    """ Divide the CSV file at ``url``, a local file or a resource in
+    the download cache, into ``parts`` partitions of about equal size,
+    or more if these would be larger than ``max_size`` bytes. There may
+    be fewer if the file has few line breaks outside quotes. Returns
+    None if the file can't be divided, as it is neither, or compressed;
+    it then has to be read as a whole. An empty file, or one with a
+    header only, has no partitions. """
+    path = util.local_copy(url)
+    mapping = util.map_file(path) if path is not None else None
+    if mapping is None:
+        return None
+    try:
+        return _partition(path, mapping, parts, max_size)
+    finally:
+        mapping.close()
+
+def _partition(path, mapping, parts, max_size):
+    lines = util.LineReader(util.mapped_blocks(mapping))
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return []
+
+    # Offsets of the start of each range.
+    size = len(mapping)
+    start = lines.offset
+    parts = max(parts, (size - start) // max_size)
+    boundaries = [start]
+    position, quotes = start, 0
+    for i in range(1, parts):
+        target = start + (size - start) * i // parts
+        if target <= position:
+            # The last range already reaches past this one.
+            continue
+        quotes += _count(mapping, position, target, '"')
+        position = target
+        # Move on to the first line break outside quotes.
+        while position < size:
+            cut = mapping.find('\n', position)
+            if cut == -1:
+                position = size
+                break
+            quotes += _count(mapping, position, cut, '"')
+            position = cut + 1
+            if quotes % 2 == 0:
+                break
+        if position >= size:
+            break
+        boundaries.append(position)
+
+    ends = boundaries[1:] + [size]
+    partitions = [Partition(path, offset, end, header)
+                  for offset, end in zip(boundaries, ends) if end > offset]
+    log.info("Divided %s into %d partitions", path, len(partitions))
+    return partitions
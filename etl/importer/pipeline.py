@@ -0,0 +1,148 @@
+"""
+Background stages for the importer.
+
+An import reads the source, converts each line and writes the result to
+the database. Run one after another, network and database latency add
+up. The stages here run the reading and the writing in threads of their
+own, joined to the converting thread by bounded queues: a full queue
+blocks the stage feeding it, so memory use stays flat whichever stage
+is the bottleneck.
+"""
+
+import logging
+import sys
+from Queue import Queue, Full, Empty
+from itertools import islice
+from threading import Thread, Event
+
+log = logging.getLogger(__name__)
+
+# Marks the end of a stream of items on a queue.
+_END = object()
+
+# How long blocked stages wait before checking whether to give up.
+_POLL_INTERVAL = 0.1
+
+
+class Stage(object):
+    """ A thread connected to the rest of the import by a bounded queue.
+    Exceptions raised in the thread are re-raised in the thread which
+    talks to the stage. """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = Queue(maxsize)
+        self.exc_info = None
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.work()
+        except BaseException:
+            self.exc_info = sys.exc_info()
+            self.stopped.set()
+
+    def work(self):
+        raise NotImplementedError("work not implemented in Stage")
+
+    def _put(self, item):
+        """ Put ``item`` on the queue, returning False if the stage was
+        stopped while waiting for room. """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _reraise(self):
+        if self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    @property
+    def depth(self):
+        return "%s %d/%d" % (self.name, self.queue.qsize(),
+                             self.queue.maxsize)
+
+
+class Fetcher(Stage):
+    """ Iterate over ``source`` in a background thread, keeping up to
+    ``maxsize`` chunks of ``chunk_size`` items ready for the consumer.
+    """
+
+    def __init__(self, source, name='fetch', maxsize=64, chunk_size=256):
+        super(Fetcher, self).__init__(name, maxsize)
+        self.source = source
+        self.chunk_size = chunk_size
+
+    def work(self):
+        source = iter(self.source)
+        while True:
+            chunk = list(islice(source, self.chunk_size))
+            if not chunk or not self._put(chunk):
+                break
+        self._put(_END)
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                try:
+                    chunk = self.queue.get(timeout=_POLL_INTERVAL)
+                except Empty:
+                    if self.stopped.is_set():
+                        break
+                    continue
+                if chunk is _END:
+                    break
+                for item in chunk:
+                    yield item
+            self._reraise()
+        finally:
+            self.stop()
+
+
+class Writer(Stage):
+    """ Call ``write`` on each item put to this stage, in a background
+    thread. ``close`` waits for all items to be written. """
+
+    def __init__(self, write, name='write', maxsize=1000):
+        super(Writer, self).__init__(name, maxsize)
+        self.write = write
+
+    def work(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=_POLL_INTERVAL)
+            except Empty:
+                if self.stopped.is_set():
+                    break
+                continue
+            if item is _END:
+                break
+            self.write(*item)
+
+    def put(self, *item):
+        self._reraise()
+        if not self._put(item):
+            self._reraise()
+
+    def close(self):
+        """ Wait for the queued items to be written, and re-raise any
+        exception that stopped the writer. """
+        self._put(_END)
+        self.thread.join()
+        self._reraise()
@@ -2,9 +2,26 @@ import sys
 import logging
 log = logging.getLogger(__name__)
 
-def ckan_import(package_name, **kwargs):
+def _job_options():
+    """ When running as a daemon job, checkpoint imports to the job's
+    checkpoint file and resume from it if the job is restarted, and
+    write errors to the job's error file. Job ids are reused, so the
+    error file only keeps the errors of an earlier run if it is resumed.
+    """
+    from openspending.etl.command import daemon
+
+    path = daemon.current_checkpoint_path()
+    if path is None:
+        return {}
+    return {'checkpoint': path, 'resume': True,
+            'error_file': daemon.current_errors_path()}
+
+def ckan_import(package_name, workers=None, **kwargs):
+    from openspending.etl import download, util
     from openspending.etl.importer import CKANImporter
 
+    util.enable_ranged_download(download.CONNECTIONS)
+    util.enable_download_cache()
     importer = CKANImporter(package_name)
     importer.on_error = lambda e: log.warn(e)
 
@@ -12,35 +29,52 @@ def ckan_import(package_name, **kwargs):
         'max_errors': 500
     }
 
+    if workers:
+        opts['workers'] = int(workers)
+
+    opts.update(_job_options())
     opts.update(kwargs)
 
     importer.run(**opts)
 
-def csv_import(resource_url, model_url, **kwargs):
-    import urllib
+def csv_import(resource_url, model_url, workers=None, **kwargs):
     from openspending.lib import json
-    from openspending.etl import util
+    from openspending.etl import download, util
     from openspending.etl.importer import CSVImporter
 
-    model = json.load(urllib.urlopen(model_url))
+    util.enable_ranged_download(download.CONNECTIONS)
+    util.enable_download_cache()
+    model = json.load(util.open_url(model_url))
     csv = util.urlopen_lines(resource_url)
     importer = CSVImporter(csv, model, resource_url)
 
-    importer.run(**kwargs)
+    opts = _job_options()
+
+    if workers:
+        opts['workers'] = int(workers)
+
+    opts.update(kwargs)
+
+    importer.run(**opts)
+
 
 def remove_dataset(dataset_name):
     log.warn("Dropping dataset '%s'", dataset_name)
     from openspending.model import Dataset, meta as db
+    from openspending.etl.importer import fingerprint
     dataset = Dataset.by_name(dataset_name)
     dataset.drop()
+    fingerprint.remove_index(dataset_name)
     db.session.delete(dataset)
     db.session.commit()
 
 def drop_datasets():
     from openspending.model import Dataset, meta as db
+    from openspending.etl.importer import fingerprint
     log.info("Dropping all datasets in database...")
     for dataset in db.session.query(Dataset):
         dataset.drop()
+        fingerprint.remove_index(dataset.name)
     log.info("Done!")
 
 # What follow are helper tasks for testing the etl.command.daemon module.
@@ -1,3 +1,6 @@
+import gzip
+import os
+import tempfile
 from os.path import dirname, join
 from StringIO import StringIO
 from urlparse import urlunparse
@@ -6,7 +9,12 @@ from openspending.model import Dataset
 from openspending.model import meta as db
 from openspending.lib import json
 
-from openspending.etl.importer import CSVImporter
+from openspending.etl import util
+from openspending.etl.importer import CSVImporter, DataError, ImporterError, \
+    TooManyErrorsError
+from openspending.etl.importer.checkpoint import Checkpoint
+from openspending.etl.importer.errors import ErrorLog, ErrorSummary, \
+    read_errors, summary_path
 
 from ... import DatabaseTestCase, helpers as h
 
@@ -78,6 +86,292 @@ class TestCSVImporter(DatabaseTestCase):
         h.assert_equal(entry['time']['name'], '2010-01-01')
         h.assert_equal(entry['amount'], 100.00)
 
+    def test_batched_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        importer = CSVImporter(data, dmodel)
+        importer.run(batch_size=2)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        entries = list(dataset.entries())
+        h.assert_equal(len(entries), 5)
+
+    def test_batched_import_errors(self):
+        data, model = csvimport_fixture('erroneous_values')
+        importer = CSVImporter(data, model)
+        importer.run(batch_size=3)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].line_number, 5)
+
+    def test_batched_import_load_error(self):
+        # An entry failing to load rolls back its batch, which is then
+        # loaded entry by entry.
+        data, model = csvimport_fixture('simple')
+        importer = CSVImporter(data, model)
+        load = Dataset.load
+        def failing_load(dataset, entry):
+            if entry['entry_id'] == '3':
+                raise ImporterError("Entry 3 can't be loaded")
+            return load(dataset, entry)
+        with h.patch.object(Dataset, 'load', failing_load):
+            importer.run(batch_size=4)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].line_number, 3)
+
+        dataset = db.session.query(Dataset).first()
+        h.assert_equal(sorted(e['entry_id'] for e in dataset.entries()),
+                       ['1', '2', '4', '5'])
+
+    def test_parallel_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        importer = CSVImporter(data, dmodel)
+        importer.run(workers=2)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        entries = list(dataset.entries())
+        h.assert_equal(len(entries), 5)
+
+    def test_parallel_import_errors(self):
+        data, model = csvimport_fixture('import_errors')
+        importer = CSVImporter(data, model)
+        importer.run(dry_run=True, workers=2)
+
+        data, model = csvimport_fixture('import_errors')
+        serial = CSVImporter(data, model)
+        serial.run(dry_run=True)
+
+        h.assert_equal([(e.line_number, e.message) for e in importer.errors],
+                       [(e.line_number, e.message) for e in serial.errors])
+
+    def test_partitioned_import(self):
+        data, model = csvimport_fixture('simple')
+        header = data.readline()
+        # A stray quote in an unquoted field throws off where the middle
+        # partitions are cut. The first is read sequentially up to the
+        # last, which is read by a worker.
+        records = ['%d,From %sA,2010-01-01,%s,"To\nB"\n'
+                   % (i, '"' if i in (7, 107) else '', amount)
+                   for i, amount in enumerate(['1.00', 'x', '', '2.50'] * 50)]
+        records[70] = '\n'
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(header + "".join(records))
+
+        try:
+            importer = CSVImporter(util.urlopen_lines(path), model, path)
+            h.assert_true(len(importer.partitions(4)) > 1)
+            importer.run(dry_run=True, workers=4)
+            serial = CSVImporter(util.urlopen_lines(path), model, path)
+            serial.run(dry_run=True)
+        finally:
+            os.remove(path)
+
+        h.assert_equal(importer.line_number, 199)
+        h.assert_equal(serial.line_number, 199)
+        h.assert_true(serial.errors)
+        h.assert_equal([(e.line_number, e.message) for e in importer.errors],
+                       [(e.line_number, e.message) for e in serial.errors])
+
+    def test_pipelined_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        importer = CSVImporter(data, dmodel)
+        importer.run(pipeline=True, batch_size=2)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        entries = list(dataset.entries())
+        h.assert_equal(len(entries), 5)
+
+    def test_pipelined_import_errors(self):
+        data, model = csvimport_fixture('erroneous_values')
+        importer = CSVImporter(data, model)
+        importer.run(pipeline=True)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].line_number, 5)
+
+    def save_checkpoint(self, path, model):
+        """ Save a checkpoint after line 3 of the ``simple`` fixture at
+        ``path``, with an offset after line 2. """
+        with open(path) as f:
+            header_and_two_lines = len("".join(f.readline() for i in range(3)))
+
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        Checkpoint(checkpoint).save({
+            'line_number': 3,
+            'offset_line': 2,
+            'offset': header_and_two_lines,
+            'resource': util.resource_digest(path),
+            'model': model
+        })
+        return checkpoint
+
+    def test_resume_from_checkpoint(self):
+        _, dmodel = csvimport_fixture('simple')
+        path = h.fixture_path('csv_import/simple/data.csv')
+        importer = CSVImporter(util.urlopen_lines(path), dmodel, path)
+        checkpoint = self.save_checkpoint(path, importer.model_digest())
+
+        importer.run(checkpoint=checkpoint, resume=True)
+        h.assert_equal(importer.errors, [])
+        h.assert_false(os.path.exists(checkpoint),
+                       "Checkpoint should be removed after the import")
+
+        dataset = db.session.query(Dataset).first()
+        entries = list(dataset.entries())
+        h.assert_equal(len(entries), 2)
+
+    def test_resume_with_changed_model(self):
+        _, dmodel = csvimport_fixture('simple')
+        path = h.fixture_path('csv_import/simple/data.csv')
+        importer = CSVImporter(util.urlopen_lines(path), dmodel, path)
+        checkpoint = self.save_checkpoint(path, importer.model_digest())
+        dmodel['mapping']['amount']['label'] = 'Total'
+
+        importer.run(checkpoint=checkpoint, resume=True)
+        h.assert_equal(importer.errors, [])
+        dataset = db.session.query(Dataset).first()
+        h.assert_equal(len(list(dataset.entries())), 5)
+
+    def test_checkpoint_advances_past_failed_lines(self):
+        _, model = csvimport_fixture('simple')
+        model['mapping']['amount']['column'] = 'paid_by'
+        path = h.fixture_path('csv_import/simple/data.csv')
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(checkpoint)
+
+        importer = CSVImporter(util.urlopen_lines(path), model, path)
+        try:
+            h.assert_raises(TooManyErrorsError, importer.run,
+                            checkpoint=checkpoint, checkpoint_interval=2,
+                            max_errors=4)
+            state = Checkpoint(checkpoint).load()
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        h.assert_equal(state['line_number'], 2)
+        h.assert_equal(state['offset_line'], 2)
+
+    def test_compressed_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        fd, path = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+        fp = gzip.open(path, 'wb')
+        fp.write(data.read())
+        fp.close()
+
+        importer = CSVImporter(util.urlopen_lines(path), dmodel, path)
+        importer.run(dry_run=True)
+        h.assert_equal(importer.errors, [])
+        h.assert_equal(importer.line_number, 5)
+
+    def test_incremental_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        lines = data.read().splitlines(True)
+        fingerprint_dir = tempfile.mkdtemp()
+
+        importer = CSVImporter(StringIO("".join(lines)), dmodel)
+        importer.run(incremental=True, fingerprint_dir=fingerprint_dir)
+        h.assert_equal(importer.errors, [])
+        h.assert_equal(importer.fingerprints.counts,
+                       {'new': 5, 'changed': 0, 'unchanged': 0})
+
+        # Change the amount of entry 2 and drop entry 5.
+        lines[2] = lines[2].replace('100.00', '200.00')
+        importer = CSVImporter(StringIO("".join(lines[:5])), dmodel)
+        importer.run(incremental=True, fingerprint_dir=fingerprint_dir)
+        h.assert_equal(importer.errors, [])
+        h.assert_equal(importer.fingerprints.counts,
+                       {'new': 0, 'changed': 1, 'unchanged': 3})
+        h.assert_equal(importer.fingerprints.removed, 1)
+
+    def test_incremental_import_with_errors_keeps_entries(self):
+        data, dmodel = csvimport_fixture('simple')
+        lines = data.read().splitlines(True)
+        fingerprint_dir = tempfile.mkdtemp()
+
+        importer = CSVImporter(StringIO("".join(lines)), dmodel)
+        importer.run(incremental=True, fingerprint_dir=fingerprint_dir)
+
+        # Entry 2 fails to convert: it is not reported or dropped as
+        # removed, so it isn't new to the next import.
+        broken = list(lines)
+        broken[2] = broken[2].replace('100.00', 'a hundred')
+        importer = CSVImporter(StringIO("".join(broken)), dmodel)
+        importer.run(incremental=True, fingerprint_dir=fingerprint_dir)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.fingerprints.removed, 0)
+
+        importer = CSVImporter(StringIO("".join(lines)), dmodel)
+        importer.run(incremental=True, fingerprint_dir=fingerprint_dir)
+        h.assert_equal(importer.fingerprints.counts,
+                       {'new': 0, 'changed': 0, 'unchanged': 5})
+
+    def test_tuple_rows_import(self):
+        data, dmodel = csvimport_fixture('sample')
+        importer = CSVImporter(data, dmodel)
+        importer.run(tuple_rows=True)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        h.assert_equal(len(list(dataset.entries())), 29)
+
+    def test_tuple_rows_errors(self):
+        for name in ('import_errors', 'erroneous_values', 'malformed'):
+            data, model = csvimport_fixture(name)
+            importer = CSVImporter(data, model)
+            importer.run(dry_run=True)
+            data, model = csvimport_fixture(name)
+            tuple_importer = CSVImporter(data, model)
+            tuple_importer.run(dry_run=True, tuple_rows=True)
+
+            h.assert_equal(map(str, tuple_importer.errors),
+                           map(str, importer.errors))
+
+    def test_columnar_import(self):
+        data, dmodel = csvimport_fixture('sample')
+        importer = CSVImporter(data, dmodel)
+        importer.run(columnar=True)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        h.assert_equal(len(list(dataset.entries())), 29)
+
+    def test_columnar_errors(self):
+        for name in ('import_errors', 'erroneous_values', 'malformed'):
+            for tuple_rows in (False, True):
+                data, model = csvimport_fixture(name)
+                importer = CSVImporter(data, model)
+                importer.run(dry_run=True)
+                data, model = csvimport_fixture(name)
+                columnar_importer = CSVImporter(data, model)
+                columnar_importer.run(dry_run=True, columnar=True,
+                                      tuple_rows=tuple_rows)
+
+                h.assert_equal(map(str, columnar_importer.errors),
+                               map(str, importer.errors))
+
+    def test_dimension_keys_import(self):
+        data, dmodel = csvimport_fixture('simple')
+        importer = CSVImporter(data, dmodel)
+        importer.run(dimension_keys=True, batch_size=2)
+        h.assert_equal(importer.errors, [])
+
+        dataset = db.session.query(Dataset).first()
+        h.assert_equal(len(list(dataset.entries())), 5)
+        # All entries have the same 'from' and 'to' members.
+        h.assert_equal(len(importer.dimension_keys.keys), 2)
+        h.assert_equal(importer.dimension_keys.hits, 8)
+        h.assert_equal(importer.members.hits, 8)
+
+    def test_members_not_encoded_row_at_a_time(self):
+        data, dmodel = csvimport_fixture('simple')
+        importer = CSVImporter(data, dmodel)
+        importer.run()
+        h.assert_equal(importer.members, None)
+
     def test_import_errors(self):
         data, model = csvimport_fixture('import_errors')
 
@@ -87,6 +381,128 @@ class TestCSVImporter(DatabaseTestCase):
         h.assert_equal(importer.errors[0].line_number, 1,
                        "Should detect missing date colum in line 1")
 
+    def test_error_file(self):
+        data, model = csvimport_fixture('import_errors')
+        fd, error_file = tempfile.mkstemp()
+        os.close(fd)
+
+        importer = CSVImporter(data, model)
+        importer.errors = ErrorLog(keep=1)
+        importer.run(dry_run=True, error_file=error_file)
+
+        records = list(read_errors(error_file))
+        h.assert_true(len(importer.errors) > 1, "Should have errors")
+        h.assert_equal(len(records), len(importer.errors))
+        h.assert_equal(len(list(importer.errors)), 1)
+        h.assert_equal(importer.errors.dropped, len(importer.errors) - 1)
+        h.assert_equal(records[0]['line_number'], 1)
+        h.assert_equal(records[-1]['line_number'],
+                       importer.errors[0].line_number)
+        h.assert_true(records[0]['invalid'][0]['attribute'])
+
+    def test_error_file_summary(self):
+        data, model = csvimport_fixture('import_errors')
+        fd, error_file = tempfile.mkstemp()
+        os.close(fd)
+
+        importer = CSVImporter(data, model)
+        importer.run(dry_run=True, error_file=error_file)
+
+        summary = ErrorSummary.load(summary_path(error_file))
+        h.assert_equal(summary.groups, importer.errors.summary.groups)
+        h.assert_equal(unicode(summary), unicode(importer.errors.summary))
+
+        # A resumed job continues the summary.
+        errors = ErrorLog()
+        errors.open(error_file, append=True)
+        h.assert_equal(errors.summary.groups, summary.groups)
+        errors.close()
+
+        # A new import of the job replaces the errors.
+        data, model = csvimport_fixture('simple')
+        importer = CSVImporter(data, model)
+        importer.run(dry_run=True, error_file=error_file)
+        h.assert_equal(importer.errors, [])
+        h.assert_equal(list(read_errors(error_file)), [])
+        h.assert_equal(ErrorSummary.load(summary_path(error_file)).groups, {})
+        os.remove(error_file)
+        os.remove(summary_path(error_file))
+
+    def test_errors_not_serialized_without_error_file(self):
+        data, model = csvimport_fixture('import_errors')
+        importer = CSVImporter(data, model)
+        with h.patch.object(DataError, 'to_dict') as to_dict:
+            importer.run(dry_run=True)
+        h.assert_true(len(importer.errors) > 1, "Should have errors")
+        h.assert_false(to_dict.called)
+
+    def test_error_summary(self):
+        data, model = csvimport_fixture('import_errors')
+        importer = CSVImporter(data, model)
+        importer.run(dry_run=True)
+
+        groups = importer.errors.summary.groups
+        counts = sorted((k[0], g['count']) for k, g in groups.items())
+        h.assert_equal(counts, [('amount', 2), ('time', 4)])
+        time_samples = [g['samples'] for k, g in groups.items()
+                        if k[0] == 'time'][0]
+        h.assert_equal(time_samples[0], (1, '0'))
+        h.assert_equal(len(time_samples), 3)
+
+    def test_overlong_line(self):
+        data, model = csvimport_fixture('simple')
+        lines = data.readlines()
+        lines.insert(2, "x" * 200 + "\n")
+        importer = CSVImporter(util.LineReader(lines), model)
+
+        with h.assert_raises(DataError) as cm:
+            importer.run(dry_run=True, max_line_length=100)
+        h.assert_equal(cm.exception.offset, len("".join(lines[:2])))
+        h.assert_equal(cm.exception.line_number, 2)
+        h.assert_true(importer.aborted)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].to_dict()['offset'],
+                       cm.exception.offset)
+
+    def test_skip_overlong_lines(self):
+        data, model = csvimport_fixture('simple')
+        lines = data.readlines()
+        lines.insert(2, "x" * 200 + "\n")
+        importer = CSVImporter(util.LineReader(lines), model)
+        importer.run(dry_run=True, max_line_length=100, skip_long_lines=True)
+
+        # The overlong line is record 2, and is counted, so the last of
+        # the five records which were read is record 6.
+        h.assert_equal(importer.line_number, 6)
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].line_number, 2)
+        h.assert_true("byte %d" % len("".join(lines[:2]))
+                      in importer.errors[0].message)
+
+    def test_overlong_line_in_blocks(self):
+        # Lines converted in blocks are read ahead, but the overlong line
+        # is only reported when its turn comes, as when reading line by
+        # line.
+        data, model = csvimport_fixture('simple')
+        lines = data.readlines()
+        lines.insert(3, "x" * 200 + "\n")
+        lines[1] = lines[1].replace('100.00', 'n/a')
+        for runs, options in enumerate(({}, {'workers': 2},
+                                        {'columnar': True}), 1):
+            importer = CSVImporter(util.LineReader(lines), model)
+            importer.run(dry_run=True, max_line_length=60,
+                         skip_long_lines=True, **options)
+            h.assert_equal([e.line_number for e in importer.errors], [1, 3])
+            h.assert_equal(importer.line_number, 6)
+
+            importer = CSVImporter(util.LineReader(lines), model)
+            h.assert_raises(DataError, importer.run, max_lines=10,
+                            max_line_length=60, **options)
+            h.assert_equal(importer.line_number, 3)
+            dataset = db.session.query(Dataset).first()
+            h.assert_equal([e['entry_id'] for e in dataset.entries()],
+                           ['2'] * runs)
+
     def test_empty_csv(self):
         empty_data = StringIO("")
         _, model = csvimport_fixture('default')
@@ -100,6 +516,26 @@ class TestCSVImporter(DatabaseTestCase):
 
         h.assert_true("Didn't read any lines of data" in str(importer.errors[1].message))
 
+    def test_missing_columns(self):
+        data, model = csvimport_fixture('simple')
+        model['mapping']['amount']['column'] = 'total'
+        model['mapping']['to']['fields'][1]['column'] = 'recipient'
+        importer = CSVImporter(data, model)
+        importer.run(dry_run=True)
+
+        h.assert_equal(len(importer.errors), 1)
+        h.assert_equal(importer.errors[0].line_number, 0)
+        h.assert_true("'total'" in importer.errors[0].message)
+        h.assert_true("'recipient'" in importer.errors[0].message)
+
+    def test_missing_columns_raise_errors(self):
+        data, model = csvimport_fixture('simple')
+        model['mapping']['amount']['column'] = 'total'
+        importer = CSVImporter(data, model)
+        h.assert_raises(DataError, importer.run, dry_run=True,
+                        raise_errors=True)
+        h.assert_equal(len(importer.errors), 1)
+
     def test_malformed_csv(self):
         data, model = csvimport_fixture('malformed')
         importer = CSVImporter(data, model)
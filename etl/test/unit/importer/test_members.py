@@ -0,0 +1,34 @@
+from openspending.etl.importer.members import MemberTable
+
+from ... import TestCase, helpers as h
+
+class TestMemberTable(TestCase):
+
+    def test_shares_equal_members(self):
+        table = MemberTable(['from', 'to'])
+        first = table.encode({'from': {'name': u'a', 'label': u'A'},
+                              'to': {'name': u'b', 'label': u'B'},
+                              'amount': 1.0})
+        second = table.encode({'from': {'name': u'b', 'label': u'B'},
+                               'to': {'name': u'a', 'label': u'A'},
+                               'amount': 2.0})
+        third = table.encode({'from': {'name': u'a', 'label': u'A'},
+                              'to': {'name': u'b', 'label': u'Other'},
+                              'amount': 3.0})
+
+        assert third['from'] is first['from']
+        assert third['to'] is not first['to']
+        # Members are shared per dimension only.
+        assert second['from'] is not first['to']
+        h.assert_equal(third['to'], {'name': u'b', 'label': u'Other'})
+        h.assert_equal(len(table.members), 5)
+        h.assert_equal(table.hits, 1)
+
+    def test_max_members(self):
+        table = MemberTable(['to'], max_members=1)
+        table.encode({'to': {'name': u'a'}})
+        entry = {'to': {'name': u'b'}}
+        member = entry['to']
+        table.encode(entry)
+        assert table.encode({'to': {'name': u'b'}})['to'] is not member
+        h.assert_equal(len(table.members), 1)
@@ -0,0 +1,127 @@
+import csv
+import os
+import tempfile
+
+from openspending.etl.importer.partition import partition_csv, \
+    PartitionError
+
+from ... import TestCase, helpers as h
+
+def fixture_path(name):
+    return h.fixture_path('csv_import/%s/data.csv' % name)
+
+def write_csv(data):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    return path
+
+def csv_rows(path):
+    """ The rows of a CSV file read as a whole. """
+    with open(path, 'rb') as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        return header, [row for row in reader if row]
+
+def partitioned_rows(partitions):
+    return [row for partition in partitions for row in partition.rows()]
+
+class TestPartition(TestCase):
+
+    def check_partitions(self, path, parts):
+        header, rows = csv_rows(path)
+        partitions = partition_csv(path, parts)
+        h.assert_true(1 <= len(partitions) <= parts)
+        for partition in partitions:
+            h.assert_equal(partition.header, header)
+        for before, after in zip(partitions, partitions[1:]):
+            h.assert_equal(before.end, after.start)
+        h.assert_equal(partitions[-1].end, os.path.getsize(path))
+        h.assert_equal(partitioned_rows(partitions), rows)
+        return partitions
+
+    def test_mexico(self):
+        for parts in range(1, 12):
+            self.check_partitions(fixture_path('mexico'), parts)
+        h.assert_equal(len(partition_csv(fixture_path('mexico'), 3)), 3)
+
+    def test_quoted_line_break(self):
+        # The first record of the malformed fixture has a line break in
+        # a quoted field, which is not cut.
+        path = fixture_path('malformed')
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        second_record = data.index('\n2,') + 1
+        for parts in range(1, 6):
+            partitions = self.check_partitions(path, parts)
+            h.assert_true(partitions[-1].start <= second_record)
+        h.assert_equal(partition_csv(path, 2)[1].start, second_record)
+
+    def test_fixtures(self):
+        for name in ('empty_additional_date', 'erroneous_values',
+                     'import_errors', 'lbhf', 'sample',
+                     'simple', 'successful_import', 'uganda'):
+            for parts in (1, 2, 5, 16):
+                self.check_partitions(fixture_path(name), parts)
+
+    def test_quotes_across_lines(self):
+        path = write_csv('a,b\n1,"x\n""\n2,""y""\n3"\n"4\n5",z\n' * 50 +
+                         '6,7\n')
+        try:
+            for parts in range(1, 40):
+                self.check_partitions(path, parts)
+        finally:
+            os.remove(path)
+
+    def test_stray_quotes(self):
+        # A quote within an unquoted field is an ordinary character,
+        # which throws the count of quotes off.
+        data = 'a,b\n' + '1,x"y\n2,"p\nq"\n' * 100
+        path = write_csv(data)
+        try:
+            header, rows = csv_rows(path)
+            partitions = partition_csv(path, 8)
+            read = []
+            for partition in partitions:
+                try:
+                    read.append(partition.rows())
+                except PartitionError:
+                    read.append(None)
+            h.assert_true(None in read)
+            # A partition which does start at the start of a record has
+            # its rows right if it is found to end at the end of one.
+            starts = [4 + 14 * (i // 2) + 6 * (i % 2) for i in range(200)]
+            h.assert_equal(partitions[0].start, starts[0])
+            for partition, partition_rows in zip(partitions, read):
+                if partition_rows is not None and partition.start in starts:
+                    first = starts.index(partition.start)
+                    h.assert_equal(partition_rows,
+                                   rows[first:first + len(partition_rows)])
+                    h.assert_true(partition.end in starts + [len(data)])
+        finally:
+            os.remove(path)
+
+    def test_line_too_long(self):
+        path = write_csv('a,b\n1,2\n' + 'x' * 100 + '\n3,4\n')
+        try:
+            partition, = partition_csv(path, 1)
+            h.assert_raises(PartitionError, partition.rows, 50)
+            h.assert_equal(partition.rows(), [['1', '2'], ['x' * 100],
+                                              ['3', '4']])
+        finally:
+            os.remove(path)
+
+    def test_max_size(self):
+        path = write_csv('a,b\n' + '1,2\n' * 1000)
+        try:
+            h.assert_equal(len(partition_csv(path, 1, max_size=400)), 10)
+        finally:
+            os.remove(path)
+
+    def test_not_partitioned(self):
+        h.assert_equal(partition_csv("http://example.org/data.csv", 4), None)
+        path = write_csv("a,b\n")
+        try:
+            h.assert_equal(partition_csv(path, 4), [])
+        finally:
+            os.remove(path)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import urllib2
+from StringIO import StringIO
+
+from openspending.etl.cache import DownloadCache
+
+from .. import TestCase, helpers as h
+
+
+class Response(StringIO):
+    def __init__(self, data, headers):
+        StringIO.__init__(self, data)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+def not_modified(request):
+    raise urllib2.HTTPError(request.get_full_url(), 304, "Not Modified",
+                            {}, None)
+
+class TestDownloadCache(TestCase):
+
+    def setup(self):
+        super(TestDownloadCache, self).setup()
+        self.directory = tempfile.mkdtemp()
+        self.patcher = h.patch('openspending.etl.cache.urllib2.urlopen')
+        self.urlopen = self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+        super(TestDownloadCache, self).teardown()
+
+    def respond(self, data, **headers):
+        self.urlopen.side_effect = lambda request: Response(data, headers)
+
+    def test_conditional_get(self):
+        cache = DownloadCache(self.directory)
+        self.respond("a,b\n1,2\n", etag='"v1"')
+        h.assert_equal(cache.open("http://x/data.csv").read(), "a,b\n1,2\n")
+
+        self.urlopen.side_effect = not_modified
+        fp = cache.open("http://x/data.csv")
+        h.assert_equal(fp.read(), "a,b\n1,2\n")
+        request = self.urlopen.call_args[0][0]
+        h.assert_equal(request.get_header('If-none-match'), '"v1"')
+
+    def test_changed_resource_read_once(self):
+        opener = h.Mock()
+        cache = DownloadCache(self.directory, opener=opener)
+        opener.side_effect = lambda url: Response("a,b\n1,2\n",
+                                                  {'etag': '"v1"'})
+        cache.open("http://x/data.csv").read()
+
+        self.respond("a,b\n3,4\n", etag='"v2"')
+        h.assert_equal(cache.open("http://x/data.csv").read(), "a,b\n3,4\n")
+        h.assert_equal(opener.call_count, 1)
+        h.assert_equal(self.urlopen.call_count, 1)
+        h.assert_equal(cache.lookup("http://x/data.csv")[0], '"v2"')
+
+    def test_current_copy(self):
+        cache = DownloadCache(self.directory)
+        h.assert_equal(cache.current_copy("http://x/data.csv"), None)
+        self.respond("a,b\n1,2\n", etag='"v1"')
+        cache.open("http://x/data.csv").read()
+
+        self.urlopen.side_effect = not_modified
+        path = cache.current_copy("http://x/data.csv")
+        h.assert_equal(open(path).read(), "a,b\n1,2\n")
+        request = self.urlopen.call_args[0][0]
+        h.assert_equal(request.get_method(), 'HEAD')
+        h.assert_equal(request.get_header('If-none-match'), '"v1"')
+
+        self.respond("", etag='"v2"')
+        h.assert_equal(cache.current_copy("http://x/data.csv"), None)
+        h.assert_equal(self.urlopen.call_args[0][0].get_method(), 'HEAD')
+
+    def test_partial_read_is_not_cached(self):
+        cache = DownloadCache(self.directory)
+        self.respond("a,b\n1,2\n", etag='"v1"')
+        fp = cache.open("http://x/data.csv")
+        fp.read(4)
+        fp.read(0)
+        fp.close()
+        h.assert_equal(cache.lookup("http://x/data.csv"), None)
+
+    def test_truncated_download_is_not_cached(self):
+        cache = DownloadCache(self.directory)
+        self.respond("a,b\n", etag='"v1"', **{'content-length': '8'})
+        cache.open("http://x/data.csv").read()
+        h.assert_equal(cache.lookup("http://x/data.csv"), None)
+
+    def test_identical_content_stored_once(self):
+        cache = DownloadCache(self.directory)
+        self.respond("a,b\n1,2\n", **{'last-modified': 'Mon, 01 Oct 2012'})
+        cache.open("http://x/one.csv").read()
+        cache.open("http://x/two.csv").read()
+        h.assert_equal(len(os.listdir(os.path.join(self.directory,
+                                                   'objects'))), 1)
+        h.assert_equal(cache.lookup("http://x/one.csv")[2],
+                       cache.lookup("http://x/two.csv")[2])
+
+    def test_least_recently_used_evicted(self):
+        cache = DownloadCache(self.directory, max_size=25)
+        for name in ('one', 'two'):
+            self.respond(name * 3, etag=name)
+            cache.open("http://x/%s.csv" % name).read()
+        self.urlopen.side_effect = not_modified
+        cache.open("http://x/one.csv").read()
+
+        self.respond("three" * 2, etag='three')
+        cache.open("http://x/three.csv").read()
+        h.assert_true(cache.lookup("http://x/one.csv") is not None)
+        h.assert_equal(cache.lookup("http://x/two.csv"), None)
+        h.assert_true(cache.lookup("http://x/three.csv") is not None)
@@ -0,0 +1,112 @@
+import bz2
+import gzip
+import zipfile
+from StringIO import StringIO
+
+from openspending.etl import compression
+
+from .. import TestCase, helpers as h
+
+DATA = "".join("%d,line %d,%d.00\n" % (i, i, i * 10) for i in range(5000))
+
+def gzipped(data):
+    out = StringIO()
+    fp = gzip.GzipFile(fileobj=out, mode='wb')
+    fp.write(data)
+    fp.close()
+    return out.getvalue()
+
+def zipped(*files, **kwargs):
+    out = StringIO()
+    archive = zipfile.ZipFile(out, 'w', **kwargs)
+    for i, data in enumerate(files):
+        archive.writestr('data%d.csv' % i, data)
+    archive.close()
+    return out.getvalue()
+
+def blocks_of(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def decompress(data, size=7):
+    kind = compression.detect_compression(data[:64])
+    return "".join(compression.decompress_blocks(blocks_of(data, size), kind))
+
+class TestCompression(TestCase):
+
+    def test_detect_compression(self):
+        h.assert_equal(compression.detect_compression(gzipped(DATA)), 'gzip')
+        h.assert_equal(compression.detect_compression(bz2.compress(DATA)),
+                       'bz2')
+        h.assert_equal(compression.detect_compression(zipped(DATA)), 'zip')
+        h.assert_equal(compression.detect_compression(DATA), None)
+        h.assert_equal(compression.detect_compression("BZh,a,b\n"), None)
+
+    def test_headers_do_not_override_magic(self):
+        headers = {'content-type': 'application/x-gzip'}
+        h.assert_equal(compression.detect_compression(DATA, headers), None)
+
+    def test_gzip(self):
+        h.assert_equal(decompress(gzipped(DATA)), DATA)
+        h.assert_equal(decompress(gzipped(DATA), size=100000), DATA)
+
+    def test_gzip_members(self):
+        data = gzipped(DATA[:1000]) + gzipped(DATA[1000:])
+        h.assert_equal(decompress(data), DATA)
+        h.assert_equal(decompress(data, size=100000), DATA)
+
+    def test_bz2(self):
+        h.assert_equal(decompress(bz2.compress(DATA)), DATA)
+        data = bz2.compress(DATA[:1000]) + bz2.compress(DATA[1000:])
+        h.assert_equal(decompress(data), DATA)
+
+    def test_zip(self):
+        h.assert_equal(decompress(zipped(DATA)), DATA)
+        h.assert_equal(decompress(zipped(DATA, compression=zipfile.ZIP_DEFLATED)),
+                       DATA)
+
+    def test_zip_of_several_files(self):
+        data = zipped(DATA, DATA, compression=zipfile.ZIP_DEFLATED)
+        h.assert_raises(compression.CompressedDataError, decompress, data)
+        h.assert_raises(compression.CompressedDataError, decompress, data,
+                        size=100000)
+
+    def test_corrupt_data(self):
+        data = gzipped(DATA)
+        data = data[:100] + "x" * 100 + data[200:]
+        h.assert_raises(compression.CompressedDataError, decompress, data)
+
+    def test_block_size(self):
+        blocks = compression.decompress_blocks([gzipped("x" * 1000000)],
+                                               'gzip')
+        h.assert_true(max(len(b) for b in blocks) <= compression.BLOCK_SIZE)
+
+    def test_truncated_data(self):
+        for data in (gzipped(DATA), gzipped(DATA) + gzipped(DATA),
+                     bz2.compress(DATA)):
+            for cut in (len(data) // 2 + 10, len(data) - 30, len(data) - 1):
+                h.assert_raises(compression.CompressedDataError,
+                                decompress, data[:cut])
+                h.assert_raises(compression.CompressedDataError,
+                                decompress, data[:cut], size=100000)
+
+    def test_truncated_zip(self):
+        # The central directory at the end is not read, so only cuts
+        # into the file data count.
+        for data in (zipped(DATA),
+                     zipped(DATA, compression=zipfile.ZIP_DEFLATED)):
+            for cut in (40, len(data) // 2):
+                h.assert_raises(compression.CompressedDataError,
+                                decompress, data[:cut])
+                h.assert_raises(compression.CompressedDataError,
+                                decompress, data[:cut], size=100000)
+
+    def test_zip_crc(self):
+        data = zipped(DATA)
+        at = data.index("line 100")
+        data = data[:at] + "LINE" + data[at + 4:]
+        h.assert_raises(compression.CompressedDataError, decompress, data)
+
+    def test_bz2_block_size(self):
+        blocks = compression.decompress_blocks([bz2.compress("x" * 1000000)],
+                                               'bz2')
+        h.assert_true(max(len(b) for b in blocks) <= compression.BLOCK_SIZE)
@@ -0,0 +1,223 @@
+import re
+import socket
+from StringIO import StringIO
+
+from openspending.etl import download
+
+from .. import TestCase, helpers as h
+
+DATA = "".join("%d,line %d\n" % (i, i) for i in range(20000))
+
+
+class Response(StringIO):
+    def __init__(self, data, code=200, headers=None, fail_after=None):
+        StringIO.__init__(self, data)
+        self.code = code
+        self.headers = headers or {}
+        self.fail_after = fail_after
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def read(self, size=-1):
+        if self.fail_after is not None:
+            if self.tell() >= self.fail_after:
+                raise socket.error("Connection reset by peer")
+            size = min(size, self.fail_after - self.tell())
+        return StringIO.read(self, size)
+
+class Server(object):
+    """ Answers requests for DATA, with range support unless
+    ``ranges`` is False. """
+
+    def __init__(self, ranges=True, break_once=(), etag=None,
+                 if_range=True):
+        self.ranges = ranges
+        self.break_once = set(break_once)
+        self.etag = etag
+        self.if_range = if_range
+        self.requests = []
+
+    def __call__(self, request):
+        if isinstance(request, basestring):
+            request = download.urllib2.Request(request)
+        range_ = request.get_header('Range')
+        self.requests.append((request.get_method(), range_))
+        headers = {'content-length': str(len(DATA))}
+        if self.ranges:
+            headers['accept-ranges'] = 'bytes'
+        if self.etag:
+            headers['etag'] = self.etag
+        if request.get_method() == 'HEAD':
+            self.head_response = Response('', headers=headers)
+            return self.head_response
+        if self.if_range and \
+                request.get_header('If-range', self.etag) != self.etag:
+            range_ = None
+
+        start, end = 0, len(DATA) - 1
+        code = 200
+        if range_ and self.ranges:
+            start, end = re.match(r'bytes=(\d+)-(\d*)', range_).groups()
+            start, end = int(start), int(end or len(DATA) - 1)
+            headers = {'content-range': 'bytes %d-%d/%d'
+                       % (start, end, len(DATA)),
+                       'content-length': str(end + 1 - start)}
+            if self.etag:
+                headers['etag'] = self.etag
+            code = 206
+        fail_after = None
+        if start in self.break_once:
+            self.break_once.remove(start)
+            fail_after = 100
+        return Response(DATA[start:end + 1], code, headers, fail_after)
+
+class TestRangedDownload(TestCase):
+
+    def setup(self):
+        super(TestRangedDownload, self).setup()
+        self.patcher = h.patch('openspending.etl.download.urllib2.urlopen')
+        self.urlopen = self.patcher.start()
+        self.sleep_patcher = h.patch('openspending.etl.download.time.sleep')
+        self.sleep_patcher.start()
+
+    def teardown(self):
+        self.sleep_patcher.stop()
+        self.patcher.stop()
+        super(TestRangedDownload, self).teardown()
+
+    def test_ranges(self):
+        server = self.urlopen.side_effect = Server()
+        fp = download.open_ranged("http://x/data.csv", connections=3,
+                                  range_size=10000)
+        h.assert_true(isinstance(fp, download.RangedReader))
+        h.assert_equal(fp.read(), DATA)
+        ranges = sorted(r for m, r in server.requests if r)
+        h.assert_equal(len(ranges), len(fp.ranges))
+        fp.close()
+
+    def test_head_response_closed(self):
+        server = self.urlopen.side_effect = Server()
+        download.open_ranged("http://x/data.csv", range_size=10000).close()
+        h.assert_true(server.head_response.closed)
+
+    def test_small_reads(self):
+        self.urlopen.side_effect = Server()
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_equal("".join(iter(lambda: fp.read(777), "")), DATA)
+
+    def test_broken_range_resumed(self):
+        server = self.urlopen.side_effect = Server(break_once=[10000])
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_equal(fp.read(), DATA)
+        h.assert_true(('GET', 'bytes=10100-19999') in server.requests)
+
+    def test_no_range_support(self):
+        server = self.urlopen.side_effect = Server(ranges=False)
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_false(isinstance(fp, download.RangedReader))
+        h.assert_equal(fp.read(), DATA)
+
+    def test_small_resource(self):
+        self.urlopen.side_effect = Server()
+        fp = download.open_ranged("http://x/data.csv",
+                                  range_size=len(DATA))
+        h.assert_false(isinstance(fp, download.RangedReader))
+
+    def changed_after_head(self, server):
+        def urlopen(request):
+            response = server(request)
+            if request.get_method() == 'HEAD':
+                server.etag = '"v2"'
+            return response
+        self.urlopen.side_effect = urlopen
+
+    def test_changed_resource(self):
+        server = Server(etag='"v1"')
+        self.changed_after_head(server)
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_raises(download.RangeNotSatisfiedError, fp.read)
+        request = self.urlopen.call_args[0][0]
+        h.assert_equal(request.get_header('If-range'), '"v1"')
+
+    def test_changed_resource_without_if_range(self):
+        server = Server(etag='"v1"', if_range=False)
+        self.changed_after_head(server)
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_raises(download.RangeNotSatisfiedError, fp.read)
+
+    def test_range_ignored(self):
+        server = Server()
+        def ignore_ranges(request):
+            if request.get_method() == 'HEAD':
+                return server(request)
+            return Response(DATA, headers={})
+        self.urlopen.side_effect = ignore_ranges
+        fp = download.open_ranged("http://x/data.csv", range_size=10000)
+        h.assert_raises(download.RangeNotSatisfiedError, fp.read)
+
+class TestResumingReader(TestCase):
+
+    def setup(self):
+        super(TestResumingReader, self).setup()
+        self.patcher = h.patch('openspending.etl.download.urllib2.urlopen')
+        self.urlopen = self.patcher.start()
+        self.sleep_patcher = h.patch('openspending.etl.download.time.sleep')
+        self.sleep = self.sleep_patcher.start()
+
+    def teardown(self):
+        self.sleep_patcher.stop()
+        self.patcher.stop()
+        super(TestResumingReader, self).teardown()
+
+    def test_resumed(self):
+        server = self.urlopen.side_effect = Server(break_once=[0, 100])
+        fp = download.open_resumable("http://x/data.csv")
+        h.assert_equal("".join(iter(lambda: fp.read(77), "")), DATA)
+        h.assert_equal(server.requests, [('GET', None),
+                                         ('GET', 'bytes=100-'),
+                                         ('GET', 'bytes=200-')])
+
+    def test_truncated_response_resumed(self):
+        server = Server()
+        def truncate_once(request):
+            if not server.requests:
+                server(request)
+                return Response(DATA[:5000],
+                                headers={'content-length': str(len(DATA))})
+            return server(request)
+        self.urlopen.side_effect = truncate_once
+        fp = download.open_resumable("http://x/data.csv")
+        h.assert_equal(fp.read(), DATA)
+        h.assert_equal(server.requests[-1], ('GET', 'bytes=5000-'))
+
+    def test_gives_up(self):
+        self.urlopen.side_effect = Server(break_once=[0])
+        fp = download.open_resumable("http://x/data.csv", retries=3)
+        self.urlopen.side_effect = socket.error("Connection refused")
+        with h.assert_raises(download.IncompleteDownloadError):
+            fp.read()
+        h.assert_equal(self.sleep.call_count, 3)
+        delays = [args[0] for args, kwargs in self.sleep.call_args_list]
+        h.assert_equal(delays, sorted(delays))
+
+    def test_changed_resource(self):
+        server = self.urlopen.side_effect = Server(break_once=[0],
+                                                   etag='"v1"')
+        fp = download.open_resumable("http://x/data.csv")
+        server.etag = '"v2"'
+        h.assert_raises(download.RangeNotSatisfiedError, fp.read)
+        h.assert_equal(len(server.requests), 2)
+
+    def test_offset(self):
+        request = download.urllib2.Request("http://x/data.csv",
+                                           headers={'Range': 'bytes=1000-'})
+        server = self.urlopen.side_effect = Server(break_once=[1000])
+        fp = download.ResumingReader("http://x/data.csv",
+                                     download.urllib2.urlopen(request),
+                                     offset=1000)
+        h.assert_equal(fp.read(), DATA[1000:])
+        h.assert_equal(server.requests[-1], ('GET', 'bytes=1100-'))
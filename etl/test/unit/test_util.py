@@ -1,3 +1,7 @@
+import gzip
+import os
+import random
+import tempfile
 from StringIO import StringIO
 
 from openspending.etl import util
@@ -5,6 +9,85 @@ from openspending.lib.util import hash_values
 
 from .. import TestCase, helpers as h
 
+# The block-wise universal newline splitter ``util.ilines`` used to be,
+# kept as a reference. It was created by Scott David Daniels on Wed, 23
+# Jun 2004, licensed under the PSF:
+# http://code.activestate.com/recipes/286165-ilines-universal-newlines-from-any-data-source/
+def recipe_ilines(source_iterable):
+    '''yield lines as in universal-newlines from a stream of data blocks'''
+    tail = ''
+    for block in source_iterable:
+        if not block:
+            continue
+        if tail.endswith('\015'):
+            yield tail[:-1] + '\012'
+            if block.startswith('\012'):
+                pos = 1
+            else:
+                tail = ''
+        else:
+            pos = 0
+        try:
+            while True: # While we are finding LF.
+                npos = block.index('\012', pos) + 1
+                try:
+                    rend = npos - 2
+                    rpos = block.index('\015', pos, rend)
+                    if pos:
+                        yield block[pos : rpos] + '\n'
+                    else:
+                        yield tail + block[:rpos] + '\n'
+                    pos = rpos + 1
+                    while True: # While CRs 'inside' the LF
+                        rpos = block.index('\015', pos, rend)
+                        yield block[pos : rpos] + '\n'
+                        pos = rpos + 1
+                except ValueError:
+                    pass
+                if '\015' == block[rend]:
+                    if pos:
+                        yield block[pos : rend] + '\n'
+                    else:
+                        yield tail + block[:rend] + '\n'
+                elif pos:
+                    yield block[pos : npos]
+                else:
+                    yield tail + block[:npos]
+                pos = npos
+        except ValueError:
+            pass
+        # No LFs left in block.  Do all but final CR (in case LF)
+        try:
+            while True:
+                rpos = block.index('\015', pos, -1)
+                if pos:
+                    yield block[pos : rpos] + '\n'
+                else:
+                    yield tail + block[:rpos] + '\n'
+                pos = rpos + 1
+        except ValueError:
+            pass
+
+        if pos:
+            tail = block[pos:]
+        else:
+            tail += block
+    if tail:
+        yield tail
+
+def random_lines(rng, count, endings, min_length=0):
+    return ''.join('x' * rng.randint(min_length, 20) + rng.choice(endings)
+                   for i in range(count)) + 'x' * rng.randint(0, 3)
+
+def random_blocks(rng, data):
+    blocks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(0, 30)
+        blocks.append(data[pos:pos + size])
+        pos += size
+    return blocks
+
 
 @h.patch('openspending.etl.util.urlopen')
 def test_urlopen_lines(urlopen_mock):
@@ -15,6 +98,230 @@ def test_urlopen_lines(urlopen_mock):
     h.assert_equal(lines,
                    ["line one\n", "line two\n", "line three"])
 
+@h.patch('openspending.etl.util.urlopen')
+def test_urlopen_lines_compressed(urlopen_mock):
+    data = StringIO()
+    fp = gzip.GzipFile(fileobj=data, mode='wb')
+    fp.write("line one\nline two\r\nline three")
+    fp.close()
+    urlopen_mock.side_effect = lambda url: StringIO(data.getvalue())
+
+    h.assert_equal(list(util.urlopen_lines("http://none")),
+                   ["line one\n", "line two\n", "line three"])
+    # Offsets count bytes of the decompressed data.
+    h.assert_equal(list(util.urlopen_lines("http://none", 9)),
+                   ["line two\n", "line three"])
+
+def test_line_reader_offsets():
+    data = "one\r\ntwo\rthree\nfour"
+    reader = util.LineReader([data[:4], data[4:9], data[9:]])
+
+    lines = []
+    for line in reader:
+        lines.append((line, reader.offset))
+
+    h.assert_equal(lines, [("one\n", 5), ("two\n", 9), ("three\n", 15),
+                           ("four", 19)])
+
+def test_line_reader_block_boundaries():
+    data = "a\r\nb\r\rc\n\nd\re\r"
+    expected = ["a\n", "b\n", "\n", "c\n", "\n", "d\n", "e\r"]
+    for size in range(1, len(data) + 1):
+        blocks = [data[i:i + size] for i in range(0, len(data), size)]
+        h.assert_equal(list(util.LineReader(blocks)), expected)
+
+def test_ilines_same_as_recipe():
+    # The recipe gets a LF at the start of a block wrong (it looks at
+    # the end of the block for a CR), so it is given all data in one
+    # block without empty lines.
+    rng = random.Random(42)
+    for i in range(200):
+        data = random_lines(rng, 20, ['\n', '\r\n', '\r'], min_length=1)
+        h.assert_equal(list(util.ilines(random_blocks(rng, data))),
+                       list(recipe_ilines([data])))
+
+def test_ilines_mixed_line_endings():
+    rng = random.Random(42)
+    for i in range(200):
+        data = random_lines(rng, 20, ['\n', '\r\n', '\r']) + '\n'
+        expected = [line.rstrip('\r\n') + '\n'
+                    for line in data.splitlines(True)]
+        blocks = random_blocks(rng, data)
+        h.assert_equal(list(util.ilines(blocks)), expected)
+
+        reader = util.LineReader(blocks)
+        for line in reader:
+            pass
+        h.assert_equal(reader.offset, len(data))
+
+def test_line_reader_max_line_length():
+    data = "one\n" + "x" * 20 + "\ntwo\n"
+    blocks = [data[i:i + 8] for i in range(0, len(data), 8)]
+    lines = iter(util.LineReader(blocks, max_line_length=10))
+
+    h.assert_equal(next(lines), "one\n")
+    with h.assert_raises(util.LineTooLongError) as cm:
+        next(lines)
+    h.assert_equal(cm.exception.offset, 4)
+
+def test_line_reader_skips_overlong_lines():
+    data = "one\n" + "x" * 20 + "\r\ntwo\r" + "y" * 30 + "\rthree"
+    errors = []
+    for size in range(1, len(data) + 1):
+        blocks = [data[i:i + size] for i in range(0, len(data), size)]
+        reader = util.LineReader(blocks, max_line_length=10,
+                                 on_overlong=errors.append)
+        lines = []
+        for line in reader:
+            lines.append((line, reader.offset))
+
+        h.assert_equal(lines, [("one\n", 4), ("two\n", 30),
+                               ("three", len(data))])
+        h.assert_equal([e.offset for e in errors], [4, 30])
+        del errors[:]
+
+def write_temp(data):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    return path
+
+def test_urlopen_lines_local_file():
+    data = "one\ntwo\nthree\nfour"
+    path = write_temp(data)
+    try:
+        for url in (path, 'file://' + path):
+            reader = util.urlopen_lines(url)
+            h.assert_true(isinstance(reader, util.MappedLineReader))
+            lines = [(line, reader.offset) for line in reader]
+            h.assert_equal(lines, [("one\n", 4), ("two\n", 8),
+                                   ("three\n", 14), ("four", 18)])
+            h.assert_true(reader.direct)
+
+        reader = util.urlopen_lines(path, 8, ["header\n"])
+        h.assert_equal(list(reader), ["header\n", "three\n", "four"])
+    finally:
+        os.remove(path)
+
+def test_mapped_line_reader_same_as_line_reader():
+    rng = random.Random(42)
+    for endings in (['\n'], ['\n', '\r\n', '\r']):
+        data = random_lines(rng, 2000, endings) + '\n'
+        path = write_temp(data)
+        try:
+            mapping = util.map_file(path)
+            reader = util.MappedLineReader(mapping, max_line_length=100)
+            expected = util.LineReader([data], max_line_length=100)
+            lines = [(line, reader.offset) for line in reader]
+            h.assert_equal(lines, [(line, expected.offset)
+                                   for line in expected])
+            h.assert_equal(reader.direct, endings == ['\n'])
+        finally:
+            os.remove(path)
+
+def test_mapped_line_reader_falls_back_per_block():
+    data = "a,b\n" * 100 + "c,d\r\n" + "e,f\n" * 100 + "x" * 30 + "\ng"
+    path = write_temp(data)
+    try:
+        for max_line_length in (None, 20):
+            reader = util.MappedLineReader(util.map_file(path),
+                                           max_line_length=max_line_length,
+                                           on_overlong=lambda e: None)
+            reader.block_size = 64
+            expected = util.LineReader([data], max_line_length=max_line_length,
+                                       on_overlong=lambda e: None)
+            lines = iter(reader)
+            h.assert_equal(next(lines), "a,b\n")
+            h.assert_true(reader.direct)
+            h.assert_equal(reader.offset, 4)
+            lines = [("a,b\n", 4)] + [(line, reader.offset) for line in lines]
+            h.assert_equal(lines, [(line, expected.offset)
+                                   for line in expected])
+            h.assert_false(reader.direct)
+    finally:
+        os.remove(path)
+
+def test_mapped_line_reader_overlong_lines():
+    data = "one\n" + "x" * 20 + "\ntwo\n"
+    path = write_temp(data)
+    try:
+        errors = []
+        reader = util.MappedLineReader(util.map_file(path),
+                                       max_line_length=10,
+                                       on_overlong=errors.append)
+        h.assert_equal(list(reader), ["one\n", "two\n"])
+        h.assert_false(reader.direct)
+        h.assert_equal([e.offset for e in errors], [4])
+    finally:
+        os.remove(path)
+
+def test_map_file_falls_back():
+    path = write_temp("")
+    h.assert_equal(util.map_file(path), None)
+    os.remove(path)
+    data = StringIO()
+    fp = gzip.GzipFile(fileobj=data, mode='wb')
+    fp.write("line one\n")
+    fp.close()
+    path = write_temp(data.getvalue())
+    try:
+        h.assert_equal(util.map_file(path), None)
+        h.assert_equal(list(util.urlopen_lines(path)), ["line one\n"])
+    finally:
+        os.remove(path)
+
+def test_resource_digest_local_file():
+    data = "a,b\n" + "1,2\n" * 20000
+    path = write_temp(data)
+    try:
+        digest = util.resource_digest(path)
+        h.assert_equal(util.resource_digest(path), digest)
+        with open(path, 'ab') as fp:
+            fp.write("3,4\n")
+        h.assert_not_equal(util.resource_digest(path), digest)
+    finally:
+        os.remove(path)
+
+class Response(StringIO):
+    def __init__(self, data, headers):
+        StringIO.__init__(self, data)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+@h.patch('openspending.etl.util.urllib2.urlopen')
+def test_resource_digest_http(urlopen_mock):
+    urlopen_mock.return_value = Response("", {'etag': '"v1"'})
+    digest = util.resource_digest("http://none")
+    h.assert_equal(urlopen_mock.call_args[0][0].get_method(), 'HEAD')
+    h.assert_true(urlopen_mock.return_value.closed)
+    urlopen_mock.return_value = Response("", {'etag': '"v2"'})
+    h.assert_not_equal(util.resource_digest("http://none"), digest)
+    h.assert_equal(urlopen_mock.call_count, 2)
+
+@h.patch('openspending.etl.util.urllib2.urlopen')
+def test_resource_digest_http_without_validators(urlopen_mock):
+    def urlopen(request):
+        if request.get_method() == 'HEAD':
+            return Response("", {})
+        return Response("a,b\n" * 10, {})
+    urlopen_mock.side_effect = urlopen
+    digest = util.resource_digest("http://none", size=8)
+    request = urlopen_mock.call_args[0][0]
+    h.assert_equal(request.get_header('Range'), 'bytes=0-7')
+    h.assert_equal(urlopen_mock.call_count, 2)
+    urlopen_mock.side_effect = lambda request: Response("a,c\n" * 10, {})
+    h.assert_not_equal(util.resource_digest("http://none", size=8), digest)
+
+@h.patch('openspending.etl.util.urlopen')
+def test_line_reader_close(urlopen_mock):
+    fp = urlopen_mock.return_value = Response("a\nb\n", {})
+    reader = util.urlopen_lines("http://none")
+    h.assert_equal(next(iter(reader)), "a\n")
+    reader.close()
+    h.assert_true(fp.closed)
+
 def test_hash():
     h.assert_equal(hash_values(["foo", "bar", "baz"]),
                    '976cbe6da83475797cbb55f3fc50bf174b138a60')
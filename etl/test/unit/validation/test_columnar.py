@@ -0,0 +1,60 @@
+from ... import TestCase, helpers as h
+from openspending.etl.validation import columnar, types
+
+MAPPING = {
+    "amount": {"column": "amount", "datatype": "float"},
+    "time": {"column": "date", "datatype": "date"},
+    "to": {"fields": [
+        {"name": "name", "column": "to", "datatype": "id"},
+        {"name": "label", "column": "to", "datatype": "string"}
+        ]
+    }
+}
+
+ROWS = [
+    {"amount": "1,000.50", "date": "2011-12", "to": "Foo"},
+    {"amount": "-3", "date": "2011-12", "to": "Bar"},
+    {"amount": "1e5", "date": "2011", "to": "Foo"},
+    {"amount": "1-2", "date": "n/a", "to": ""},
+    {"amount": "", "date": "2011-12-31", "to": "Bar"},
+    {"amount": None, "date": "2010", "to": "Foo"},
+    {"date": "2010", "to": "Foo"}
+]
+
+def _row_wise(convert, rows):
+    results = []
+    for row in rows:
+        try:
+            results.append((convert(row), None))
+        except types.Invalid, e:
+            results.append((None, e.children))
+    return results
+
+def _compare(convert, rows):
+    expected = _row_wise(convert, rows)
+    results = columnar.convert_block(convert, rows)
+    h.assert_equal(len(results), len(expected))
+    for (data, failures), (exp_data, exp_failures) in zip(results, expected):
+        if exp_failures is None:
+            h.assert_equal(failures, None)
+            h.assert_equal(data, exp_data)
+        else:
+            h.assert_equal([(f.node.name, f.column, f.value, f.msg)
+                            for f in failures],
+                           [(f.node.name, f.column, f.value, f.msg)
+                            for f in exp_failures])
+
+class TestColumnar(TestCase):
+
+    def test_convert_block(self):
+        _compare(types.compile_mapping(MAPPING), ROWS)
+
+    def test_convert_block_without_numpy(self):
+        with h.patch('openspending.etl.validation.columnar.numpy', None):
+            _compare(types.compile_mapping(MAPPING), ROWS)
+
+    def test_convert_block_indexed(self):
+        header = ["to", "amount", "date"]
+        rows = [[row.get(c) for c in header] for row in ROWS]
+        rows[-1] = rows[-1][:1]
+        _compare(types.compile_mapping(MAPPING).bind(header), rows)
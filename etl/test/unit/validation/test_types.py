@@ -1,3 +1,6 @@
+import pickle
+from datetime import datetime
+
 from ... import TestCase, helpers as h
 from openspending.etl.validation import types
 
@@ -43,3 +46,158 @@ class TestTypes(TestCase):
         assert 'foo' in out, out
         assert out['foo']==5.0
 
+    def test_compile_mapping_reuse(self):
+        mapping = {
+                    "foo": {"column": "foo",
+                           "datatype": "float"},
+                    "bar": {"fields": [
+                        {"name": "name", "column": "bar_name",
+                            "datatype": "id"}
+                        ]
+                    }
+                  }
+        convert = types.compile_mapping(mapping)
+        out = convert({"foo": "1,000.5", "bar_name": "Bar Qux"})
+        assert out['foo']==1000.5, out
+        assert out['bar']['name']=='bar-qux', out
+        out = convert({"foo": "2", "bar_name": "Other"})
+        assert out['foo']==2.0, out
+        assert out['bar']['name']=='other', out
+
+    def test_bind_header(self):
+        mapping = {
+                    "foo": {"column": "foo",
+                           "datatype": "string"},
+                    "bar": {"fields": [
+                        {"name": "name", "column": "bar_name",
+                            "datatype": "id"}
+                        ]
+                    }
+                  }
+        convert = types.compile_mapping(mapping).bind(
+            ["unused", "bar_name", "foo"], "utf8")
+        out = convert(["\xff", "Bar Qux", "K\xc3\xb6ln"])
+        assert out['foo']==u'K\xf6ln', out
+        assert out['bar']['name']=='bar-qux', out
+        try:
+            convert(["", "Bar", "\xff"])
+            assert False, "Should fail to decode"
+        except types.Invalid, i:
+            assert i.children[0].node.name=='foo', i.children
+
+    def test_date_formats(self):
+        date_type = types.DateAttributeType()
+        meta = {"column": "date", "dimension": "time"}
+        for value in ["2011-12-31", "2011-12", "2011", "2011-1", "2011-1-5",
+                      "2011-02-30", "2011-13", "0000", "11", "2011-12-31 ",
+                      "2011-12-31\n", "n/a", ""]:
+            expected = None
+            for format in ["%Y-%m-%d", "%Y-%m", "%Y"]:
+                try:
+                    expected = datetime.strptime(value, format).date()
+                    break
+                except ValueError:
+                    pass
+            result = date_type.try_convert(value, meta)
+            if expected is None:
+                assert isinstance(result, types.CastFailure), (value, result)
+            else:
+                h.assert_equal(result, expected)
+
+    def test_conversion_cache(self):
+        mapping = {
+                    "time": {"column": "date",
+                           "datatype": "date"},
+                    "other": {"column": "other_date",
+                           "datatype": "date"}
+                  }
+        convert = types.compile_mapping(mapping)
+        convert({"date": "2011-12", "other_date": "2011-12"})
+        out = convert({"date": "2011-12", "other_date": "2010"})
+        h.assert_equal(out['other'], datetime(2010, 1, 1).date())
+        h.assert_equal(convert.cache_stats(), {'date': (2, 2)})
+
+    def test_identifier_cache(self):
+        mapping = {
+                    "from": {"fields": [
+                        {"name": "name", "column": "from",
+                            "datatype": "id"}
+                        ]
+                    },
+                    "to": {"fields": [
+                        {"name": "name", "column": "to",
+                            "datatype": "id"}
+                        ]
+                    }
+                  }
+        convert = types.compile_mapping(mapping)
+        out = convert({"from": "Bar Qux", "to": "bar qux"})
+        h.assert_equal(out['from']['name'], 'bar-qux')
+        assert out['from']['name'] is out['to']['name']
+        out = convert({"from": "Bar Qux", "to": "Other"})
+        h.assert_equal(convert.cache_stats(), {'id': (1, 3)})
+
+        convert = types.compile_mapping(mapping, {'id': 0})
+        convert({"from": "Bar Qux", "to": "bar qux"})
+        h.assert_equal(convert.cache_stats(), {})
+
+    def test_compile_mapping_errors(self):
+        mapping = {
+                    "foo": {"column": "foo",
+                           "datatype": "float"}
+                  }
+        convert = types.compile_mapping(mapping)
+        h.assert_raises(types.Invalid, convert, {"foo": "n/a"})
+        try:
+            convert({"bar": "1"})
+        except types.Invalid, i:
+            assert len(i.children)==1, i.children
+            assert 'does not exist' in i.children[0].msg, i.children[0].msg
+
+    def test_invalid_value_has_default_substituted(self):
+        mapping = {
+                    "foo": {"column": "foo", "datatype": "float",
+                            "default_value": " n/a "},
+                    "bar": {"column": "bar", "datatype": "float"}
+                  }
+        convert = types.compile_mapping(mapping)
+        for convert_row, row in ((convert, {"foo": "", "bar": "x"}),
+                                 (convert.bind(["bar", "foo"]), ["x", ""])):
+            try:
+                convert_row(row)
+            except types.Invalid, i:
+                values = dict((e.column, e.value) for e in i.children)
+            h.assert_equal(values, {"foo": "n/a", "bar": "x"})
+
+    def test_try_cast_returns_failure(self):
+        type_ = types.FloatAttributeType()
+        meta = {"column": "foo", "datatype": "float"}
+        assert type_.try_cast({"foo": "1,5"}, meta)==15.0
+        failure = type_.try_cast({"foo": "n/a"}, meta)
+        assert isinstance(failure, types.CastFailure), failure
+        assert "'n/a'" in failure.message, failure.message
+        assert type_.test({"foo": "n/a"}, meta)==failure.message
+        failure = type_.try_cast({"bar": "1"}, meta)
+        assert isinstance(failure, types.CastFailure), failure
+        h.assert_raises(ValueError, type_.cast, {"foo": "n/a"}, meta)
+
+    def test_try_convert_catches_exceptions(self):
+        type_ = types.FloatAttributeType()
+        meta = {"column": "foo", "datatype": "float"}
+        failure = type_.try_convert(15, meta)
+        assert isinstance(failure, types.CastFailure), failure
+        h.assert_equal(type_.test({"foo": 15}, meta), failure.message)
+
+        convert = types.compile_mapping({"foo": {"column": "foo",
+                                                 "datatype": "float"}})
+        h.assert_raises(types.Invalid, convert, {"foo": 15})
+
+    def test_invalid_data_formats_message_lazily(self):
+        invalid = types.InvalidData('amount', 'amount', 'float', 'n/a',
+                                    template="'%s' is not a number",
+                                    template_args=('n/a',))
+        assert invalid._msg is None
+        assert invalid.msg == u"'n/a' is not a number", invalid.msg
+        copy = pickle.loads(pickle.dumps(invalid))
+        assert copy.msg == invalid.msg, copy.msg
+        assert copy.template == invalid.template
@@ -8,6 +8,7 @@ class JobController(BaseController):
         c.job_id = job_id
         c.job_running = daemon.job_running(job_id)
         c.job_log = daemon.job_log(job_id)
+        c.job_errors = daemon.job_errors(job_id)
 
         if request.is_xhr:
             return render('job/_status.html')
@@ -1,73 +1,511 @@
-from urllib import urlopen
+import hashlib
+import httplib
+import logging
+import mmap
+import os
+import sqlite3
+import urllib2
+from itertools import chain, islice
+from urllib import urlopen, url2pathname
+from urlparse import urlparse
 
 from openspending.lib.util import slugify
 
-# Created by Scott David Daniels on Wed, 23 Jun 2004, licensed under the PSF
-# http://code.activestate.com/recipes/286165-ilines-universal-newlines-from-any-data-source/
+from openspending.etl.cache import DownloadCache, DEFAULT_MAX_SIZE
+from openspending.etl.compression import detect_compression, decompress_blocks
+from openspending.etl.download import BLOCK_SIZE, head, open_ranged, \
+    open_resumable, ResumingReader
+
+log = logging.getLogger(__name__)
+
+# Default maximum length of a line read by an import. Longer lines are
+# taken to be a file without line breaks rather than data.
+MAX_LINE_LENGTH = 4 * 1024 * 1024
+
+class LineTooLongError(ValueError):
+    """ A line of the source is longer than the maximum line length. """
+
+    def __init__(self, offset, max_length):
+        ValueError.__init__(self, offset, max_length)
+        self.offset = offset
+        self.max_length = max_length
+
+    def __str__(self):
+        return "Line starting at byte %d is longer than %d bytes" \
+            % (self.offset, self.max_length)
+
+class OverlongLine(object):
+    """ Placeholder for a line which was skipped as it is longer than
+    the maximum line length, ``error`` being the LineTooLongError. """
+
+    def __init__(self, error):
+        self.error = error
+
 def ilines(source_iterable):
-    '''yield lines as in universal-newlines from a stream of data blocks'''
-    tail = ''
-    for block in source_iterable:
-        if not block:
-            continue
-        if tail.endswith('\015'):
-            yield tail[:-1] + '\012'
-            if block.startswith('\012'):
-                pos = 1
-            else:
+    """\
+    Yield lines as in universal-newlines from a stream of data blocks:
+    CRLF and CR line endings are turned into LF.
+    """
+    return iter(LineReader(source_iterable))
+
+class LineReader(object):
+    """\
+    Iterate over the lines of a stream of data blocks, turning CRLF and
+    CR line endings into LF as universal newlines do. ``offset`` is the
+    number of bytes of the source consumed up to the end of the last line
+    returned, which allows a reader to be restarted at a line boundary
+    later on.
+
+    ``prefix_lines`` are returned before any data from the source and
+    do not count towards the offset.
+
+    If ``max_line_length`` is set, no more than that many bytes of a
+    line are buffered. A longer line raises a ``LineTooLongError``,
+    unless an ``on_overlong`` callback is set: it is called with the
+    error instead, and the rest of the line is skipped.
+    """
+
+    def __init__(self, source, offset=0, prefix_lines=(),
+                 max_line_length=None, on_overlong=None):
+        self.source = source
+        self.offset = offset
+        self.prefix_lines = list(prefix_lines)
+        self.max_line_length = max_line_length
+        self.on_overlong = on_overlong
+        self._lines = self._iter_lines()
+
+    def __iter__(self):
+        return self._lines
+
+    def _iter_lines(self):
+        for line in self.prefix_lines:
+            yield line
+
+        tail = ''
+        offset = self.offset
+        skipping = False
+        for block in self.source:
+            if not block:
+                continue
+            if tail:
+                block = tail + block
+            lines = block.splitlines(True)
+            # The last line may continue in the next block; so may the
+            # LF of a CRLF if the block ends in CR.
+            tail = lines.pop()
+            if tail.endswith('\n'):
+                lines.append(tail)
                 tail = ''
-        else:
-            pos = 0
-        try:
-            while True: # While we are finding LF.
-                npos = block.index('\012', pos) + 1
-                try:
-                    rend = npos - 2
-                    rpos = block.index('\015', pos, rend)
-                    if pos:
-                        yield block[pos : rpos] + '\n'
-                    else:
-                        yield tail + block[:rpos] + '\n'
-                    pos = rpos + 1
-                    while True: # While CRs 'inside' the LF
-                        rpos = block.index('\015', pos, rend)
-                        yield block[pos : rpos] + '\n'
-                        pos = rpos + 1
-                except ValueError:
-                    pass
-                if '\015' == block[rend]:
-                    if pos:
-                        yield block[pos : rend] + '\n'
-                    else:
-                        yield tail + block[:rend] + '\n'
-                elif pos:
-                    yield block[pos : npos]
-                else:
-                    yield tail + block[:npos]
-                pos = npos
-        except ValueError:
-            pass
-        # No LFs left in block.  Do all but final CR (in case LF)
-        try:
-            while True:
-                rpos = block.index('\015', pos, -1)
-                if pos:
-                    yield block[pos : rpos] + '\n'
+            if skipping:
+                # The rest of an overlong line is dropped. Its last byte
+                # is kept, as it may be the CR of a CRLF.
+                if not lines:
+                    offset += len(tail) - 1
+                    self.offset = offset
+                    tail = tail[-1:]
+                    continue
+                offset += len(lines.pop(0))
+                self.offset = offset
+                skipping = False
+            max_length = self.max_line_length
+            if max_length and len(block) > max_length:
+                for line in lines:
+                    if len(line) > max_length:
+                        self._overlong(offset)
+                        offset += len(line)
+                        self.offset = offset
+                        continue
+                    offset += len(line)
+                    self.offset = offset
+                    yield _universal_newline(line)
+                if len(tail) > max_length:
+                    self._overlong(offset)
+                    offset += len(tail) - 1
+                    self.offset = offset
+                    tail = tail[-1:]
+                    skipping = True
+                continue
+            if '\r' not in block:
+                # Plain LF line endings, the common case: the lines can
+                # be returned as they are.
+                for line in lines:
+                    offset += len(line)
+                    self.offset = offset
+                    yield line
+                continue
+            for line in lines:
+                offset += len(line)
+                self.offset = offset
+                if line[-1] != '\n':
+                    yield line[:-1] + '\n'
+                elif line[-2:-1] == '\r':
+                    yield line[:-2] + '\n'
                 else:
-                    yield tail + block[:rpos] + '\n'
-                pos = rpos + 1
-        except ValueError:
-            pass
+                    yield line
+        if tail:
+            self.offset = offset + len(tail)
+            if not skipping:
+                yield tail
+
+    def close(self):
+        """ Close the source, if it can be closed. """
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+    def _overlong(self, offset):
+        error = LineTooLongError(offset, self.max_line_length)
+        if self.on_overlong is None:
+            raise error
+        self.on_overlong(error)
+
+class MappedLineReader(LineReader):
+    """\
+    LineReader of a local file, which is memory-mapped rather than read
+    into blocks. The mapping is checked a block of lines at a time: if a
+    block has plain LF line endings and no line longer than
+    ``max_line_length``, its lines are sliced out of the mapping as they
+    are read, without any per-line work in Python, and ``offset`` is the
+    position in the mapping. From the first block which needs newline
+    translation or overlong line handling on, the rest of the file is
+    read through the mapping as a LineReader would.
+
+    The mapping is shared and read-only, so it is backed by the page
+    cache: importers reading the same file share its pages.
+    """
+
+    # Size of the blocks of lines checked at a time.
+    block_size = 16 * BLOCK_SIZE
+
+    def __init__(self, mapping, offset=0, prefix_lines=(),
+                 max_line_length=None, on_overlong=None):
+        self.map = mapping
+        self.map.seek(offset)
+        # Whether lines are read from the mapping directly.
+        self.direct = False
+        LineReader.__init__(self, None, offset, prefix_lines,
+                            max_line_length, on_overlong)
+
+    @property
+    def offset(self):
+        if self.direct:
+            return self.map.tell()
+        return self._offset
+
+    @offset.setter
+    def offset(self, value):
+        self._offset = value
+
+    def close(self):
+        self.map.close()
+
+    def _iter_lines(self):
+        # A chain of iterators rather than a generator, so that the
+        # lines of the mapping are passed on by C code alone.
+        return chain.from_iterable(self._line_sources())
 
-        if pos:
-            tail = block[pos:]
+    def _line_sources(self):
+        prefix_lines, self.prefix_lines = self.prefix_lines, []
+        yield prefix_lines
+        position = self.map.tell()
+        while position < len(self.map):
+            count = self._plain_lines(position)
+            if count is None:
+                self.direct = False
+                self.offset = position
+                self.source = mapped_blocks(self.map, position)
+                yield LineReader._iter_lines(self)
+                return
+            self.direct = True
+            yield islice(iter(self.map.readline, ''), count)
+            position = self.map.tell()
+
+    def _plain_lines(self, start):
+        """ Return the number of lines of the block of the mapping from
+        byte ``start`` on, cut at the end of its last line, or None if
+        they don't all have LF line endings and at most
+        ``max_line_length`` bytes. """
+        max_length = self.max_line_length
+        block = self.map[start:start + max(self.block_size, max_length or 0)]
+        if start + len(block) == len(self.map):
+            # The last line of the file may have no line break.
+            end = len(block)
         else:
-            tail += block
-    if tail:
-        yield tail
+            end = block.rfind('\n') + 1
+        if not end or block.find('\r', 0, end) != -1:
+            return None
+        if max_length:
+            # Each step skips at least one line, and up to max_length
+            # bytes, so this takes few steps on a well-formed file.
+            position = 0
+            while end - position > max_length:
+                cut = block.rfind('\n', position, position + max_length)
+                if cut == -1:
+                    return None
+                position = cut + 1
+        count = block.count('\n', 0, end)
+        if block[end - 1] != '\n':
+            count += 1
+        return count
+
+def mapped_blocks(mapping, offset=0, end=None, block_size=BLOCK_SIZE):
+    """\
+    Yield blocks of data of a memory map from byte ``offset`` on, up to
+    byte ``end`` if given.
+    """
+    if end is None:
+        end = len(mapping)
+    for start in xrange(offset, end, block_size):
+        yield mapping[start:min(start + block_size, end)]
+
+def map_file(path):
+    """\
+    Return a read-only memory map of the local file at ``path``, or None
+    if it can't be mapped: it is not a regular file, is empty, or holds
+    compressed data (which has to be decompressed as it is read).
+    """
+    try:
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            return None
+        with open(path, 'rb') as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except EnvironmentError as e:
+        log.info("Not mapping %s: %s", path, e)
+        return None
+    if detect_compression(mapping[:BLOCK_SIZE]) is not None:
+        mapping.close()
+        return None
+    return mapping
+
+def _universal_newline(line):
+    if line.endswith('\r\n'):
+        return line[:-2] + '\n'
+    if line.endswith('\r'):
+        return line[:-1] + '\n'
+    return line
+
+def _local_path(url):
+    """Return the filesystem path for a local file URL or path, or None."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return url2pathname(parsed.path)
+    if not parsed.scheme or len(parsed.scheme) == 1: # Windows drive letter
+        return url
+    return None
+
+# The cache HTTP resources are opened through by open_url, if any.
+download_cache = None
+
+# Number of connections open_url downloads HTTP resources with, if the
+# server supports range requests.
+download_connections = 1
+
+def enable_download_cache(directory=None, max_size=DEFAULT_MAX_SIZE):
+    """\
+    Open HTTP resources through a DownloadCache in ``directory`` from now
+    on. If the cache can't be set up, resources are downloaded as before.
+    """
+    global download_cache
+    try:
+        download_cache = DownloadCache(directory, max_size, _download)
+    except (EnvironmentError, sqlite3.Error) as e:
+        log.warn("Not caching downloads: %s", e)
 
-def urlopen_lines(url):
-    """Yield lines from a URL"""
-    return ilines(urlopen(url))
+def enable_ranged_download(connections):
+    """\
+    Download HTTP resources over ``connections`` connections at once from
+    now on, see ``openspending.etl.download``.
+    """
+    global download_connections
+    download_connections = connections
+
+def _download(url):
+    if download_connections > 1:
+        return open_ranged(url, download_connections)
+    return open_resumable(url)
+
+def open_url(url):
+    """\
+    Open a URL for reading, through the download cache for HTTP. HTTP
+    downloads which break off are resumed, see
+    ``openspending.etl.download``.
+    """
+    if urlparse(url).scheme not in ('http', 'https'):
+        return urlopen(url)
+    if download_cache is not None:
+        return download_cache.open(url)
+    if download_connections > 1:
+        return open_ranged(url, download_connections)
+    return ResumingReader(url, urlopen(url))
+
+def read_blocks(fp, block_size=BLOCK_SIZE):
+    """Yield blocks of data from a file-like object until it is exhausted"""
+    return iter(lambda: fp.read(block_size), '')
+
+def urlopen_at(url, offset=0):
+    """\
+    Open a URL for reading from byte ``offset``. Local files are seeked,
+    HTTP resources are requested with a Range header, and if neither works
+    the data before ``offset`` is read and thrown away.
+    """
+    if not offset:
+        return urlopen(url)
+
+    path = _local_path(url)
+    if path is not None:
+        fp = open(path, 'rb')
+        fp.seek(offset)
+        return fp
+
+    if urlparse(url).scheme in ('http', 'https'):
+        request = urllib2.Request(url, headers={'Range': 'bytes=%d-' % offset})
+        fp = urllib2.urlopen(request)
+        if fp.getcode() == 206:
+            return ResumingReader(url, fp, offset=offset)
+    else:
+        fp = urlopen(url)
+
+    remaining = offset
+    while remaining > 0:
+        block = fp.read(min(remaining, BLOCK_SIZE))
+        if not block:
+            break
+        remaining -= len(block)
+    return fp
 
+def local_copy(url):
+    """\
+    Return the path of a local file URL or path, or of the copy of an
+    HTTP resource in the download cache if it is current, else None.
+    """
+    path = _local_path(url)
+    if path is not None:
+        return path
+    if download_cache is None:
+        return None
+    return download_cache.current_copy(url)
+
+def _headers(fp):
+    info = getattr(fp, 'info', None)
+    return info() if info is not None else None
+
+def _skip_bytes(blocks, count):
+    for block in blocks:
+        if count >= len(block):
+            count -= len(block)
+            continue
+        yield block[count:]
+        break
+    for block in blocks:
+        yield block
+
+def urlopen_blocks(url, offset=0):
+    """\
+    Return an iterator of the blocks of data of a URL, from byte
+    ``offset`` on. Compressed data (see ``openspending.etl.compression``)
+    is decompressed as it is read, and ``offset`` then counts bytes of
+    the decompressed data, which has to be read from the start.
+    """
+    fp = open_url(url)
+    blocks = read_blocks(fp)
+    head = next(blocks, '')
+    compression = detect_compression(head, _headers(fp))
+    if compression is None:
+        if not offset:
+            blocks = chain([head], blocks)
+        elif isinstance(fp, file):
+            # A copy from the download cache.
+            fp.seek(offset)
+            blocks = read_blocks(fp)
+        else:
+            fp.close()
+            fp = urlopen_at(url, offset)
+            blocks = read_blocks(fp)
+    else:
+        blocks = decompress_blocks(chain([head], blocks), compression)
+        if offset:
+            blocks = _skip_bytes(blocks, offset)
+    return ClosingBlocks(blocks, fp)
+
+class ClosingBlocks(object):
+    """ Iterator of the blocks of data read from ``fp``, which closes
+    it when it is closed. """
+
+    def __init__(self, blocks, fp):
+        self.blocks = blocks
+        self.fp = fp
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.blocks)
+
+    def close(self):
+        self.fp.close()
+
+def urlopen_lines(url, offset=0, prefix_lines=(), max_line_length=None,
+                  on_overlong=None):
+    """\
+    Yield lines from a URL, starting at byte ``offset``. Local files are
+    read through a MappedLineReader.
+    """
+    path = _local_path(url)
+    if path is not None:
+        mapping = map_file(path)
+        if mapping is not None:
+            return MappedLineReader(mapping, offset, prefix_lines,
+                                    max_line_length, on_overlong)
+    return LineReader(urlopen_blocks(url, offset), offset, prefix_lines,
+                      max_line_length, on_overlong)
+
+def resource_digest(url, size=BLOCK_SIZE):
+    """\
+    Return a SHA1 hex digest identifying the version of a URL, which is
+    used to tell whether a resource has changed between two imports.
+    Local files are identified by their first ``size`` bytes, size and
+    modification time. HTTP resources are identified by the
+    Content-Length, ETag and Last-Modified headers of a HEAD request, and
+    if they have neither an ETag nor a Last-Modified date, by their first
+    ``size`` bytes, which are requested as a single range.
+    """
+    path = _local_path(url)
+    if path is not None:
+        with open(path, 'rb') as fp:
+            digest = hashlib.sha1(fp.read(size))
+        stat = os.stat(path)
+        version = [stat.st_size, stat.st_mtime]
+    elif urlparse(url).scheme in ('http', 'https'):
+        try:
+            headers = head(url)
+        except (IOError, httplib.HTTPException) as e:
+            log.info("HEAD request for %s failed: %s", url, e)
+            headers = {}
+        version = [headers.get(name) for name in
+                   ('content-length', 'etag', 'last-modified')]
+        if version[1] or version[2]:
+            digest = hashlib.sha1()
+        else:
+            digest = hashlib.sha1(_read_head(url, size))
+    else:
+        fp = urlopen(url)
+        try:
+            digest = hashlib.sha1(fp.read(size))
+            headers = _headers(fp) or {}
+        finally:
+            fp.close()
+        version = [headers.get(name) for name in
+                   ('content-length', 'etag', 'last-modified')]
+    digest.update(repr(version))
+    return digest.hexdigest()
 
+def _read_head(url, size):
+    """ Return the first ``size`` bytes of the HTTP resource ``url``,
+    reading no further even if the server ignores the range. """
+    request = urllib2.Request(url, headers={
+        'Range': 'bytes=0-%d' % (size - 1)})
+    fp = urllib2.urlopen(request)
+    try:
+        return fp.read(size)
+    finally:
+        fp.close()
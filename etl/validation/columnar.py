@@ -0,0 +1,136 @@
+"""
+Column-at-a-time conversion of blocks of rows.
+
+Instead of converting each row in turn, ``convert_block`` reads all
+cells of one attribute from a block of rows and converts them
+together:
+
+ * Float columns are checked for invalid characters and parsed as a
+   whole with NumPy. The rows whose cells pass form a validity mask;
+   all other cells go through ``FloatAttributeType`` one by one, so
+   that their errors are exactly the ones of row-wise conversion.
+ * Date columns are converted once per distinct value in the block.
+ * Other columns are converted cell by cell.
+
+Errors are reported as the same ``InvalidData`` exceptions as by a
+``RowConverter``. NumPy is optional: without it, float columns are
+converted cell by cell as well.
+"""
+
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from openspending.etl.validation.types import (CastFailure,
+                                               CachedAttributeType,
+                                               DateAttributeType,
+                                               FloatAttributeType)
+
+
+def convert_block(converter, rows):
+    """ Convert a list of rows with ``converter`` (a compiled mapping),
+    returning a ``(data, failures)`` pair for each row. ``failures`` is
+    None, or the list of InvalidData errors of the row. """
+    outs = [dict((dimension, {}) for dimension in converter.compounds)
+            for row in rows]
+    failures = [None] * len(rows)
+
+    for step in converter.steps:
+        dimension, attribute, column, type_, meta, default = step
+        values, failed = convert_column(type_,
+                                        converter.read_column(rows, step),
+                                        meta)
+        # Values of failed rows are stored too, as their data is
+        # discarded anyway.
+        if attribute is None:
+            for out, value in izip(outs, values):
+                out[dimension] = value
+        else:
+            for out, value in izip(outs, values):
+                out[dimension][attribute] = value
+        for i in failed:
+            if failures[i] is None:
+                failures[i] = []
+            failures[i].append(converter._invalid(rows[i], step, values[i]))
+
+    return zip(outs, failures)
+
+def convert_column(type_, values, meta):
+    """ Convert a list of raw values of one attribute. Returns the list
+    of converted values or CastFailures, and the indices of the
+    latter. """
+    base_type = type_.type if isinstance(type_, CachedAttributeType) \
+        else type_
+    if isinstance(base_type, FloatAttributeType) and numpy is not None:
+        results = _convert_floats(type_, values, meta)
+    elif isinstance(base_type, DateAttributeType):
+        results = _convert_distinct(type_, values, meta)
+    else:
+        results = [_convert(type_, value, meta) for value in values]
+    failed = [i for i, result in enumerate(results)
+              if result.__class__ is CastFailure]
+    return results, failed
+
+def _convert(type_, value, meta):
+    if isinstance(value, CastFailure):
+        return value
+    return type_.try_convert(value, meta)
+
+def _convert_distinct(type_, values, meta):
+    converted = {}
+    results = []
+    for value in values:
+        if isinstance(value, CastFailure):
+            results.append(value)
+            continue
+        result = converted.get(value, converted)
+        if result is converted:
+            result = converted[value] = type_.try_convert(value, meta)
+        results.append(result)
+    return results
+
+def _convert_floats(type_, values, meta):
+    try:
+        # Cells which are not strings (None, CastFailures) end up as
+        # text which is not a valid number.
+        cells = numpy.array(values, dtype=numpy.unicode_)
+    except UnicodeError:
+        return [_convert(type_, value, meta) for value in values]
+
+    valid, results = _parse_floats(cells)
+    for i in numpy.flatnonzero(~valid).tolist():
+        results[i] = _convert(type_, values[i], meta)
+    return results
+
+def _parse_floats(cells):
+    """ Parse an array of strings as numbers with optional thousands
+    separators, returning a validity mask and the list of numbers.
+    Only plain numbers of up to 15 digits are marked valid, as these
+    can be computed exactly as ``mantissa / 10 ** decimals``, which
+    gives the same result as ``float()``. """
+    codes = cells.view(numpy.uint32).reshape(len(cells), -1)
+    digit = (codes >= 48) & (codes <= 57)
+    dot = codes == 46
+    minus = codes == 45
+    used = codes != 0
+
+    valid = (digit | dot | minus | (codes == 44) | ~used).all(axis=1)
+    # No NUL characters within the string, at most one decimal point,
+    # a minus sign only in front, and 1 to 15 digits.
+    valid &= (used[:, :-1] >= used[:, 1:]).all(axis=1)
+    valid &= dot.sum(axis=1) <= 1
+    valid &= minus.sum(axis=1) == minus[:, 0]
+    ndigits = digit.sum(axis=1)
+    valid &= (ndigits >= 1) & (ndigits <= 15)
+
+    place = numpy.cumsum(digit[:, ::-1], axis=1)[:, ::-1] - 1
+    place = numpy.where(digit & valid[:, None], place, 0)
+    values = numpy.where(digit, codes.astype(numpy.int64) - 48, 0)
+    mantissa = (values * 10 ** place).sum(axis=1)
+    decimals = (digit & (numpy.cumsum(dot, axis=1) > 0)).sum(axis=1)
+    numbers = mantissa / 10.0 ** decimals
+    numbers = numpy.where(minus[:, 0], -numbers, numbers)
+    return valid, numbers.tolist()
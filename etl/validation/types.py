@@ -1,5 +1,6 @@
 import re
-from datetime import datetime
+from datetime import date, datetime
+from functools import wraps
 
 from colander import SchemaNode, String, Invalid, Mapping
 
@@ -9,54 +10,137 @@ from openspending.etl.util import slugify
 class InvalidData(Invalid):
     """ Subclass of colander.Invalid to describe a data validation
     problem, including source column, dimension name and data type.
+    ``template`` is the message before the value was filled in, which
+    is used to group similar errors. If the message is not given, it
+    is only formatted from ``template`` and ``template_args`` when
+    ``msg`` is accessed.
     """
 
-    def __init__(self, column, attribute, datatype, value, message):
+    def __init__(self, column, attribute, datatype, value, message=None,
+                 template=None, template_args=()):
         node = SchemaNode(String(), name=attribute)
         self.column = column
-        self.value = value
         self.datatype = datatype
-        super(InvalidData, self).__init__(node, message)
+        self.template = template or message
+        # Not ``args``, which Exception sets.
+        self.template_args = template_args
+        # colander.Invalid sets the value, so it has to be passed on.
+        super(InvalidData, self).__init__(node, message, value)
+
+    @property
+    def msg(self):
+        if self._msg is None:
+            self._msg = CastFailure(self.template,
+                                    *self.template_args).message
+        return self._msg
+
+    @msg.setter
+    def msg(self, message):
+        self._msg = message
+
+    def __reduce__(self):
+        # Exceptions are pickled by their constructor arguments, which
+        # colander.Invalid does not keep. Needed for parallel imports.
+        return (InvalidData, (self.column, self.node.name, self.datatype,
+                              self.value, self._msg, self.template,
+                              self.template_args))
+
+
+class CastFailure(object):
+    """ Marker returned by ``try_cast`` and ``try_convert`` in place
+    of a value when conversion is not possible. The human-readable
+    message is only formatted from ``template`` and ``args`` when it
+    is accessed. """
+
+    __slots__ = ('template', 'args')
+
+    def __init__(self, template, *args):
+        self.template = template
+        self.args = args
+
+    @property
+    def message(self):
+        if self.args:
+            return unicode(self.template) % self.args
+        return unicode(self.template)
+
+    def __unicode__(self):
+        return self.message
+
+    def __repr__(self):
+        return '<CastFailure(%r)>' % self.message
+
+
+def catch_failures(try_convert):
+    """ Decorate a ``try_convert`` method so that an unexpected
+    exception, e.g. for a value which is not a string, is returned as a
+    ``CastFailure`` with the message of the exception, rather than
+    aborting the import. """
+    @wraps(try_convert)
+    def wrapper(self, value, meta):
+        try:
+            return try_convert(self, value, meta)
+        except Exception, e:
+            return CastFailure('%s', e)
+    return wrapper
 
 
 class AttributeType(object):
     """ A attribute type maintains information about the parsing
     and conversion operations possible on the attribute, providing
     methods to check if a type is applicable to a given value and
-    to convert a value to the type. """
+    to convert a value to the type. 
+
+    Subclasses implement ``try_convert``, which either returns the
+    converted value or a ``CastFailure``, so that each value only has 
+    to be parsed once. """
 
     def test(self, row, meta):
-        """ Test if the value is of the given type. The
-        default implementation calls ``cast`` and checks if
-        that throws an exception. If the conversion passes, True
-        is returned. Otherwise, a message is given back. """
-        try:
-            self.cast(row, meta)
-            return True
-        except Exception, e:
-            return unicode(e)
+        """ Test if the value is of the given type. If the 
+        conversion passes, True is returned. Otherwise, a message 
+        is given back. """
+        result = self.try_cast(row, meta)
+        if isinstance(result, CastFailure):
+            return result.message
+        return True
 
     def cast(self, row, meta):
-        """ Convert the value to the type. This may throw
-        a quasi-random exception if conversion fails (i.e. it is
-        assumed that validation was performed before and errors
-        were already handled. """
-        raise TypeError("No casting method defined!")
-
-    def _column_name(self, meta):
-        return meta.get('column')
-
-    def _column_or_default(self, row, meta):
-        """ Utility function to handle using either the column 
-        field or the default value specified. """
+        """ Convert the value to the type, raising a ValueError 
+        if conversion fails. """
+        return self._unwrap(self.try_cast(row, meta))
+
+    def convert(self, value, meta):
+        """ Convert a single value that has already been read from
+        the row (or substituted by the default value), raising a
+        ValueError if conversion fails. """
+        return self._unwrap(self.try_convert(value, meta))
+
+    def try_cast(self, row, meta):
+        """ Read the value for this attribute from the row and
+        convert it. Returns either the value or a ``CastFailure``. """
         column_name = self._column_name(meta)
         if not column_name in row:
-            raise ValueError("Column '%s' does not exist in source data." %
-                    column_name)
+            return CastFailure("Column '%s' does not exist in source data.",
+                               column_name)
         value = row.get(column_name)
         if not value and meta.get('default_value', '').strip():
             value = meta.get('default_value').strip()
-        return value
+        return self.try_convert(value, meta)
+
+    def try_convert(self, value, meta):
+        """ Convert a single value, returning either the converted
+        value or a ``CastFailure`` describing the problem. This is
+        the part of the conversion which does not depend on the row
+        layout, so that compiled mappings can call it directly. """
+        raise TypeError("No casting method defined!")
+
+    def _unwrap(self, result):
+        if isinstance(result, CastFailure):
+            raise ValueError(result.message)
+        return result
+
+    def _column_name(self, meta):
+        return meta.get('column')
 
     def __eq__(self, other):
         return self.__class__ == other.__class__
@@ -74,9 +158,12 @@ class ConstantAttributeType(AttributeType):
     def _column_name(self, meta):
         return '<constant>'
 
-    def cast(self, row, meta):
+    def try_cast(self, row, meta):
+        return self.try_convert(None, meta)
+
+    def try_convert(self, value, meta):
         if not meta.get('constant'):
-            raise ValueError('Attribute with type "constant" has an empty'
+            return CastFailure('Attribute with type "constant" has an empty'
                     'constant value.')
         return meta.get('constant')
 
@@ -84,21 +171,24 @@ class StringAttributeType(AttributeType):
     """ Test if the given values can be represented as a 
     string. """
 
-    def cast(self, row, meta):
-        value = self._column_or_default(row, meta)
-        return unicode(value)
+    @catch_failures
+    def try_convert(self, value, meta):
+        try:
+            return unicode(value)
+        except UnicodeError, ue:
+            return CastFailure('%s', ue)
 
 class IdentifierAttributeType(StringAttributeType):
     """ Type for slug fields, i.e. attributes that will be 
     converted to a URI-compatible representation. """
 
-    def cast(self, row, meta):
-        value = self._column_or_default(row, meta)
-        if not len(value):
+    @catch_failures
+    def try_convert(self, value, meta):
+        if not value:
             if meta.get('constant'):
                 return meta.get('constant')
-            raise ValueError("Value for identifier attribute is empty: %r" %
-                    meta)
+            return CastFailure("Value for identifier attribute is empty: %r",
+                               meta)
         return slugify(value)
 
 class FloatAttributeType(AttributeType):
@@ -107,14 +197,17 @@ class FloatAttributeType(AttributeType):
 
     RE = re.compile(r'^[0-9-\.,]+$')
 
-    def cast(self, row, meta):
-        value = self._column_or_default(row, meta)
+    @catch_failures
+    def try_convert(self, value, meta):
         if value is None:
-            raise ValueError("Column is empty")
+            return CastFailure("Column is empty")
         if not self.RE.match(value):
-            raise ValueError("Numbers must only contain digits, periods, "
-                             "dashes and commas: '%s'" % value)
-        return float(unicode(value).replace(",", ""))
+            return CastFailure("Numbers must only contain digits, periods, "
+                               "dashes and commas: '%s'", value)
+        try:
+            return float(unicode(value).replace(",", ""))
+        except ValueError, ve:
+            return CastFailure('%s', ve)
 
 
 class DateAttributeType(AttributeType):
@@ -123,25 +216,20 @@ class DateAttributeType(AttributeType):
     SUFFIX = ('in the format "yyyy-mm-dd", "yyyy-mm" or "yyyy", '
               'e.g. "2011-12-31".')
 
-    def test(self, row, meta):
+    # Dates in the canonical form of the accepted formats, which are
+    # parsed without strptime.
+    ISO_RE = re.compile(r'(\d{4})(?:-(\d\d)(?:-(\d\d))?)?\Z')
+
+    @catch_failures
+    def try_convert(self, value, meta):
         # version with end_column: https://gist.github.com/1261320
-        try:
-            self.cast(row, meta)
-            return True
-        except ValueError:
+        value = unicode(value)
+        match = self.ISO_RE.match(value)
+        if match is not None:
+            year, month, day = match.groups()
             try:
-                value = unicode(self._column_or_default(row, meta))
-            except ValueError, ve:
-                return unicode(ve)
-            if meta['dimension'] != 'time':
-                #if not value:
-                #    return True
-                return '"%s" can be empty or a value %s' % (
-                        meta.get('column'), self.SUFFIX)
-            return '"time" (here "%s") has to be %s.' % (value, self.SUFFIX)
-
-    def cast(self, row, meta):
-        value = unicode(self._column_or_default(row, meta))
+                return date(int(year), int(month or 1), int(day or 1))
+            except ValueError: pass
         if value:
             for format in ["%Y-%m-%d", "%Y-%m", "%Y"]:
                 try:
@@ -150,7 +238,87 @@ class DateAttributeType(AttributeType):
         #elif meta['dimension'] != 'time':
         #    # ugly logic rule #3983:
         #    return None
-        raise ValueError("'%s': invalid date value." % value)
+        if meta.get('dimension') != 'time':
+            return CastFailure('"%s" can be empty or a value %s',
+                               meta.get('column'), self.SUFFIX)
+        return CastFailure('"time" (here "%s") has to be %s.',
+                           value, self.SUFFIX)
+
+
+class ConversionCache(object):
+    """ Bounded memo of converted values, keyed by the raw value. Two
+    generations of entries are kept: when the current one is full it
+    becomes the old one, and the previous old one is dropped. Entries
+    found in the old generation are moved to the current one, so that
+    frequently used values stay cached, as with an LRU cache.
+
+    With ``intern``, equal values are stored as the same object, so
+    that e.g. all identifiers slugified from different spellings of a
+    name share one string. """
+
+    def __init__(self, size, intern=False):
+        self.size = size
+        self.intern = intern
+        self.current = {}
+        self.old = {}
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return the cached value for ``key``, or None. """
+        value = self.current.get(key)
+        if value is None:
+            value = self.old.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.put(key, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(self.current) >= self.size // 2:
+            self.old = self.current
+            self.current = {}
+            self.values = {}
+        if self.intern:
+            value = self.values.setdefault(value, value)
+        self.current[key] = value
+        return value
+
+    def __getstate__(self):
+        # Copies sent to worker processes start out empty.
+        return {'size': self.size, 'intern': self.intern}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'], state['intern'])
+
+
+class CachedAttributeType(object):
+    """ Wraps an attribute type, caching the successful conversions of
+    non-empty values. Only types whose result for a non-empty value
+    does not depend on the attribute's metadata can be cached. """
+
+    def __init__(self, type_, cache):
+        self.type = type_
+        self.cache = cache
+
+    def try_convert(self, value, meta):
+        if not value:
+            return self.type.try_convert(value, meta)
+        result = self.cache.get(value)
+        if result is None:
+            result = self.type.try_convert(value, meta)
+            if not isinstance(result, CastFailure):
+                result = self.cache.put(value, result)
+        return result
+
+    def _column_name(self, meta):
+        return self.type._column_name(meta)
+
+    def __repr__(self):
+        return repr(self.type)
 
 
 ATTRIBUTE_TYPES = {
@@ -161,21 +329,275 @@ ATTRIBUTE_TYPES = {
     'date': DateAttributeType()
     }
 
-def _cast(row, meta, attribute_name):
-    """ Test if type conversion is possible, otherwise emit an 
-    error. """
-    datatype = meta['datatype']
-    type_ = ATTRIBUTE_TYPES.get(datatype.lower().strip(),
-            StringAttributeType())
-    test_result = type_.test(row, meta)
-    if test_result is not True:
+# Sizes of the per-mapping conversion caches, by datatype. Identifiers
+# are interned, as they repeat a lot and end up in many entries.
+CACHE_SIZES = {
+    'date': 10000,
+    'id': 50000
+    }
+INTERNED = ('id',)
+
+class RowConverter(object):
+    """ A mapping compiled into a flat list of conversion steps. Each
+    step is a tuple of ``(dimension, attribute, column, type, meta,
+    default)``, where ``attribute`` is None for measures, attribute
+    dimensions and date dimensions and ``column`` is None for
+    constants. Type lookup, default values and the dimension names
+    are resolved once, so converting a row only reads the cells it
+    needs and casts them. """
+
+    def __init__(self, mapping, cache_sizes=None):
+        self.steps = []
+        self.compounds = []
+        self.caches = {}
+        self.cache_sizes = dict(CACHE_SIZES)
+        self.cache_sizes.update(cache_sizes or {})
+
+        for dimension, meta in mapping.items():
+            meta['dimension'] = dimension
+
+            # handle AttributeDimensions, Measures and DateDimensions.
+            # this is clever, but possibly not always true.
+            if 'column' in meta:
+                self._add_step(dimension, None, meta)
+            # handle CompoundDimensions.
+            else:
+                self.compounds.append(dimension)
+                for attribute in meta.get('fields', []):
+                    self._add_step(dimension, attribute['name'], attribute)
+
+    def _add_step(self, dimension, attribute, meta):
+        datatype = meta['datatype'].lower().strip()
+        type_ = ATTRIBUTE_TYPES.get(datatype, StringAttributeType())
+        if isinstance(type_, ConstantAttributeType):
+            column = None
+        else:
+            column = type_._column_name(meta)
+        if self.cache_sizes.get(datatype):
+            # One cache per datatype, shared by all its attributes.
+            if datatype not in self.caches:
+                self.caches[datatype] = ConversionCache(
+                    self.cache_sizes[datatype], datatype in INTERNED)
+            type_ = CachedAttributeType(type_, self.caches[datatype])
+        default = (meta.get('default_value') or '').strip()
+        self.steps.append((dimension, attribute, column, type_, meta,
+                           default))
+
+    @property
+    def columns(self):
+        """ The source columns read by the mapping, in mapping order. """
+        columns = []
+        for dimension, attribute, column, type_, meta, default in self.steps:
+            if column is not None and column not in columns:
+                columns.append(column)
+        return columns
+
+    def missing_columns(self, header):
+        """ Return the columns read by the mapping which are not in
+        ``header``. """
+        header = set(header)
+        return [c for c in self.columns if c not in header]
+
+    def cache_stats(self):
+        """ Return ``{datatype: (hits, misses)}`` for the conversion
+        caches. """
+        return dict((datatype, (cache.hits, cache.misses))
+                    for datatype, cache in self.caches.items())
+
+    def bind(self, header, encoding=None):
+        """ Return a converter for rows given as sequences of cells
+        in the order of ``header``, see ``IndexedRowConverter``. """
+        return IndexedRowConverter(self, header, encoding)
+
+    def __call__(self, row):
+        """ Convert a single row, raising a colander.Invalid exception
+        that collects all failed steps if conversion was unsuccessful.
+        """
+        out = dict((dimension, {}) for dimension in self.compounds)
+        failures = []
+
+        for step in self.steps:
+            dimension, attribute, column, type_, meta, default = step
+            if column is None:
+                value = type_.try_convert(None, meta)
+            elif column not in row:
+                value = CastFailure("Column '%s' does not exist in source "
+                                    "data.", column)
+            else:
+                value = row[column]
+                if not value and default:
+                    value = default
+                value = type_.try_convert(value, meta)
+
+            if isinstance(value, CastFailure):
+                failures.append(self._invalid(row, step, value))
+            elif attribute is None:
+                out[dimension] = value
+            else:
+                out[dimension][attribute] = value
+
+        if failures:
+            raise invalid_row(failures)
+
+        return out
+
+    def read_column(self, rows, step):
+        """ Read the cells of ``step`` from each of ``rows``, with the
+        default value substituted for empty cells, or a CastFailure if
+        the column does not exist. Used for columnar conversion. """
+        dimension, attribute, column, type_, meta, default = step
+        if column is None:
+            return [None] * len(rows)
+        try:
+            values = [row[column] for row in rows]
+        except KeyError:
+            failure = CastFailure("Column '%s' does not exist in source "
+                                  "data.", column)
+            values = [row.get(column, failure) for row in rows]
+        if default:
+            values = [value or default for value in values]
+        return values
+
+    def _invalid(self, row, step, failure):
+        """ Build the error for a failed step. """
+        dimension, attribute, column, type_, meta, default = step
+        if attribute is not None:
+            dimension = dimension + '.' + attribute
+        # The value the conversion failed on, i.e. with the default
+        # substituted, or None if there is no such column.
+        value = None
+        if column is not None:
+            value = row.get(column)
+            if not value and default and column in row:
+                value = default
+        return InvalidData(dimension, type_._column_name(meta),
+                           meta['datatype'], value,
+                           template=failure.template,
+                           template_args=failure.args)
+
+
+class IndexedRowConverter(RowConverter):
+    """ A ``RowConverter`` bound to the header of the source data, for
+    rows given as lists or tuples of cells. Each step reads its cell by
+    index instead of by column name, so rows don't have to be turned
+    into dicts. Like ``csv.DictReader``, cells missing from the end of
+    short rows are read as None, and if a column name appears twice
+    in the header, the last one is used. 
+
+    If an ``encoding`` is given, cells are byte strings which are only
+    decoded when they are read, so that columns which the mapping does
+    not use are never decoded. """
+
+    def __init__(self, converter, header, encoding=None):
+        self.compounds = converter.compounds
+        self.caches = converter.caches
+        self.header = list(header)
+        self.encoding = encoding
+        index = dict((column, i) for i, column in enumerate(self.header))
+        self.steps = []
+        for step in converter.steps:
+            dimension, attribute, column, type_, meta, default = step
+            if column is not None:
+                column = index.get(column, -1)
+            self.steps.append((dimension, attribute, column, type_, meta,
+                               default))
+
+    def __call__(self, row):
+        out = dict((dimension, {}) for dimension in self.compounds)
+        failures = []
+        length = len(row)
+        encoding = self.encoding
+
+        for step in self.steps:
+            dimension, attribute, index, type_, meta, default = step
+            if index is None:
+                value = type_.try_convert(None, meta)
+            elif index < 0:
+                value = CastFailure("Column '%s' does not exist in source "
+                                    "data.", type_._column_name(meta))
+            else:
+                value = row[index] if index < length else None
+                if not value:
+                    value = default or value
+                elif encoding is not None:
+                    try:
+                        value = value.decode(encoding)
+                    except UnicodeDecodeError, ue:
+                        value = CastFailure('%s', ue)
+                if not isinstance(value, CastFailure):
+                    value = type_.try_convert(value, meta)
+
+            if isinstance(value, CastFailure):
+                failures.append(self._invalid(row, step, value))
+            elif attribute is None:
+                out[dimension] = value
+            else:
+                out[dimension][attribute] = value
+
+        if failures:
+            raise invalid_row(failures)
+
+        return out
+
+    def read_column(self, rows, step):
+        dimension, attribute, index, type_, meta, default = step
+        if index is None:
+            return [None] * len(rows)
+        if index < 0:
+            return [CastFailure("Column '%s' does not exist in source "
+                                "data.", type_._column_name(meta))] * len(rows)
+        values = [row[index] if index < len(row) else None for row in rows]
+        if self.encoding is not None:
+            try:
+                values = [value.decode(self.encoding) if value else value
+                          for value in values]
+            except UnicodeDecodeError:
+                values = [self._decode(value) for value in values]
+        if default:
+            values = [value or default for value in values]
+        return values
+
+    def _decode(self, value):
+        if not value:
+            return value
         try:
-            value = type_._column_or_default(row, meta)
-        except ValueError:
-            value = None
-        raise InvalidData(attribute_name, type_._column_name(meta),
-                          datatype, value, test_result)
-    return type_.cast(row, meta)
+            return value.decode(self.encoding)
+        except UnicodeDecodeError, ue:
+            return CastFailure('%s', ue)
+
+    def _invalid(self, row, step, failure):
+        dimension, attribute, index, type_, meta, default = step
+        if attribute is not None:
+            dimension = dimension + '.' + attribute
+        value = None
+        if index is not None and index >= 0:
+            value = row[index] if index < len(row) else None
+            if not value:
+                value = default or value
+            elif self.encoding is not None:
+                value = value.decode(self.encoding, 'replace')
+        return InvalidData(dimension, type_._column_name(meta),
+                           meta['datatype'], value,
+                           template=failure.template,
+                           template_args=failure.args)
+
+
+def invalid_row(failures):
+    """ Collect the InvalidData errors for a single row into one
+    colander.Invalid exception. """
+    errors = Invalid(SchemaNode(Mapping(unknown='preserve')))
+    for failure in failures:
+        errors.add(failure)
+    return errors
+
+
+def compile_mapping(mapping, cache_sizes=None):
+    """ Compile a mapping into a ``RowConverter``, which can then be
+    applied to each row of input data. Use this instead of calling
+    ``convert_types`` in a loop. ``cache_sizes`` overrides the sizes
+    of the conversion caches (``CACHE_SIZES``); a size of 0 disables
+    caching for that datatype. """
+    return RowConverter(mapping, cache_sizes)
 
 
 def convert_types(mapping, row):
@@ -185,33 +607,4 @@ def convert_types(mapping, row):
 
     This will validate the incoming data and emit a colander.Invalid
     exception if validation was unsuccessful."""
-    out = {}
-    errors = Invalid(SchemaNode(Mapping(unknown='preserve')))
-
-    for dimension, meta in mapping.items():
-        meta['dimension'] = dimension
-
-        # handle AttributeDimensions, Measures and DateDimensions.
-        # this is clever, but possibly not always true.
-        if 'column' in meta:
-            try:
-                out[dimension] = _cast(row, meta, dimension)
-            except Invalid, i:
-                errors.add(i)
-        # handle CompoundDimensions.
-        else:
-            out[dimension] = {}
-
-            for attribute in meta.get('fields', []):
-                attribute_name = attribute['name']
-                try:
-                    out[dimension][attribute_name] = \
-                            _cast(row, attribute, dimension + '.' +
-                                    attribute_name)
-                except Invalid, i:
-                    errors.add(i)
-
-    if len(errors.children):
-        raise errors
-
-    return out
+    return compile_mapping(mapping)(row)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Benchmark for the universal newline line splitter used by the importer.
+#
+# Writes a file of random lines with a mix of LF, CRLF and CR line
+# endings (1 GB by default) and times splitting it into lines with
+# openspending.etl.util.ilines, with io.open(newline=None), and, as a
+# lower bound without any newline translation, with plain iteration
+# over the file.
+#
+#   python tools/bench_lines.py [--size MB] [--endings lf,crlf,cr] [FILE]
+
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from openspending.etl import util
+
+ENDINGS = {'lf': '\n', 'crlf': '\r\n', 'cr': '\r'}
+
+
+def write_data(fp, size, endings, seed=0):
+    rng = random.Random(seed)
+    # A pool of lines of typical CSV row lengths, to keep generation
+    # cheap.
+    pool = [','.join(str(rng.randint(0, 10 ** 6))
+                     for i in range(rng.randint(1, 30)))
+            for i in range(1000)]
+    written = 0
+    while written < size:
+        chunk = ''.join(rng.choice(pool) + rng.choice(endings)
+                        for i in range(10000))
+        fp.write(chunk)
+        written += len(chunk)
+
+def count_ilines(path):
+    with open(path, 'rb') as fp:
+        return sum(1 for line in util.ilines(util.read_blocks(fp)))
+
+def count_io_universal(path):
+    with io.open(path, 'r', newline=None, encoding='latin-1') as fp:
+        return sum(1 for line in fp)
+
+def count_plain(path):
+    with open(path, 'rb') as fp:
+        return sum(1 for line in fp)
+
+BENCHMARKS = [
+    ('util.ilines', count_ilines),
+    ('io.open(newline=None)', count_io_universal),
+    ('file iteration (LF only)', count_plain),
+]
+
+def main():
+    parser = OptionParser(usage="%prog [options] [FILE]")
+    parser.add_option('--size', type='int', default=1024,
+                      help="Size of the generated input in MB (default 1024)")
+    parser.add_option('--endings', default='lf,crlf,cr',
+                      help="Line endings to mix (default lf,crlf,cr)")
+    options, args = parser.parse_args()
+
+    if args:
+        path, remove = args[0], False
+    else:
+        endings = [ENDINGS[e] for e in options.endings.split(',')]
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        remove = True
+        with os.fdopen(fd, 'wb') as fp:
+            write_data(fp, options.size * 1024 * 1024, endings)
+
+    try:
+        size = os.path.getsize(path) / (1024.0 * 1024)
+        print "%s: %.0f MB" % (path, size)
+        for name, count in BENCHMARKS:
+            start = time.time()
+            lines = count(path)
+            elapsed = time.time() - start
+            print "%-26s %10d lines %7.2fs %8.1f MB/s" % (
+                name, lines, elapsed, size / elapsed)
+    finally:
+        if remove:
+            os.remove(path)
+
+if __name__ == '__main__':
+    sys.exit(main())